@@ -6,12 +6,13 @@ import math as m
 import os
 from extract import *
 from overlap import *
+from cache import open_cache, file_fingerprint, character_tables_fingerprint
 from pprint import pprint
 import pickle
 import json
 import ast
 
-def get_character(eig_file, folder_path_out, name, settings, spin_i, bands, permutation):
+def get_character(eig_file, folder_path_out, name, settings, spin_i, bands, permutation, overlaps=None):
     """
     Inputs:
         eig_file: string that is the path to a EIGENVAL file
@@ -22,6 +23,7 @@ def get_character(eig_file, folder_path_out, name, settings, spin_i, bands, perm
         bands: list of band indices
         upper_b: index of highest considered band
         permutation: permutation of which symmetry belongs to each class
+        overlaps: OverlapResult, read from the overlap files if not given
 
     Returns:
         characters
@@ -30,10 +32,10 @@ def get_character(eig_file, folder_path_out, name, settings, spin_i, bands, perm
         band occupation, all output grouped by degeneracy
     """
 
-    ov_path = os.path.join(folder_path_out,"Overlaps_"+name+".json")
-    f = open(ov_path,"r")
-    sym_ov_array = json.load(f)
-    f.close()
+    if overlaps is None:
+        overlaps = OverlapResult.from_files(folder_path_out, name)
+    sym_info = overlaps.symmetry_operators
+    overlaps = overlaps.overlaps
     
     round_if_close = settings['round_if_close']
     tol = settings['round_if_close_tolerance']
@@ -42,20 +44,15 @@ def get_character(eig_file, folder_path_out, name, settings, spin_i, bands, perm
     overlap_list = []
 
     for deg_bands in bands_by_degen:
-        temp = []
-        for sym_i in range(len(sym_ov_array["symmetry_operators"])):
-            sum = 0
-
-            for band_nr in deg_bands:
-                index = bands.index(int(band_nr))
-                sum = sum + ast.literal_eval(sym_ov_array["orbitals"][index]["overlaps"])[sym_i]
-                
-            temp.append(sum)
-        overlap_list.append(temp)
+        rows = [bands.index(int(band_nr)) for band_nr in deg_bands]
+        sums = overlaps[rows].sum(axis=0)
+        # The sum stays real if all overlaps of the level are real
+        is_real = np.all(overlaps[rows].imag == 0, axis=0)
+        overlap_list.append([float(s.real) if r else complex(s) for s, r in zip(sums, is_real)])
 
     sym_list = []
 
-    for sym_i in sym_ov_array["symmetry_operators"]:
+    for sym_i in sym_info:
         sym_list.append(sym_i[1])
 
     sym_list, overlap_list = average_by_class(permutation, sym_list, overlap_list, bands_by_degen)
@@ -72,7 +69,7 @@ def get_character(eig_file, folder_path_out, name, settings, spin_i, bands, perm
                 print("Imaginary part of overlap > "+str(tol)+" !!!")
                 print("_______")
                 file = open("Imag_char.txt","a+")
-                file.write(str(bands_by_degen[deg_band_i])+"  "+str(spin_i)+"  "+str(sym_ov_array["symmetry_operators"][sym_i][1])+"  "+str(ov)+"\n")
+                file.write(str(bands_by_degen[deg_band_i])+"  "+str(spin_i)+"  "+str(sym_info[sym_i][1])+"  "+str(ov)+"\n")
                 file.close()
             ov_r = np.real(ov)
             if abs(round(ov_r)-ov_r) < tol:
@@ -201,30 +198,7 @@ def order_columns(Sym_ops, name, settings, ch_table):
         multiplicity (order) of each class
     """
 
-    class_symbols = ch_table[0][1:]
-
-    mult_right_order = []
-    classes_right_order = []
-    int_previous = False
-    for foo in class_symbols:
-        try:
-            mult_right_order.append(int(foo))
-            int_previous = True
-        except:
-            classes_right_order.append(foo)
-            if not int_previous:
-                mult_right_order.append(1)
-            int_previous = False
-
-    class_symbols, class_perm, mult = sort_into_classes(Sym_ops[1], Sym_ops[0])
-
-    perm = get_class_permutation(classes_right_order, mult_right_order, class_symbols, mult)
-    
-    permutation = []
-    for p in perm:
-        permutation.append(class_perm[p])
-
-    return permutation, mult_right_order
+    return get_column_permutation(Sym_ops[1], Sym_ops[0], ch_table)
 
 
 def get_irrep_symbols(ch_table):
@@ -251,28 +225,8 @@ def get_rep(ch_table, chars, mult, irrep_tol):
         representation as array
     """
 
-    # Through projection of irreps
-    irreps = []
-    #ch = np.asfarray(chars,float)
-    ch = chars
-    #print(ch)
-    for row in ch_table[1:]:
-        irr = row[0]
-        row = np.array(list(int(r) for r in row[1:]))
-        #print(row)
-        proj = np.dot(mult*row,ch)/sum(mult)
-        #print(dot_p)
-
-        proj_r = np.real(proj)
-        if abs(np.imag(proj)) > irrep_tol:
-            irreps.append(0)
-        elif abs(proj_r-round(proj_r)) < irrep_tol:
-            irreps.append(round(proj_r))
-        else:
-            irreps.append(0)
-    if irreps == []:
-        irreps = np.zeros(len(ch_table[1:]))
-    return irreps
+    irreps, csm = IrrepProjector.from_table(ch_table, mult).irreps_and_csm([chars], irrep_tol)
+    return irreps[0].tolist()
 
 
 def get_total_irrep_string(irr_symbols, irreps):
@@ -315,24 +269,36 @@ def get_csm(ch_table, chars, mult, irrep_tol):
         representation as array
     """
 
-    irrep_csm = []
-    ch = chars
+    irreps, csm = IrrepProjector.from_table(ch_table, mult).irreps_and_csm([chars], irrep_tol)
+    return csm_to_list(csm[0])
 
-    for row in ch_table[1:]:
-        irr = row[0]
-        row = np.array(list(int(r) for r in row[1:]))
-        proj = np.dot(mult*row,ch)/sum(mult)
+def gather_characters(eig_file, name, spin_i, bands, Sym_ops, PGname, folder_path_out, settings, overlaps=None, point_group=None):
+    """
+    Finds the characters of each degenerate level of the considered bands
+    Input:
+        eig_file: path to EIGENVAL file
+        name: string with name
+        spin_i: 1 or 2 for spin up or down
+        bands: list of band indices
+        Sym_ops: symmetry operations in array
+        PGname: string with name of point group
+        folder_path_out: path of output directory
+        settings: settings dicitonary
+        overlaps: OverlapResult, read from the overlap files if not given
+        point_group: PointGroup, built here if not given
+    Returns:
+        bands grouped by degeneracy
+        array with characters of each level, shape (n_levels, n_classes)
+    """
 
-        proj_r = np.real(proj)
-        if abs(np.imag(proj)) > irrep_tol:
-            irrep_csm.append(-404)
-        else:
-            irrep_csm.append(round(100*(1-proj_r),1))
-    if irrep_csm == []:
-        irrep_csm = 100*np.ones(len(ch_table[1:]))
-    return irrep_csm
+    if point_group is None:
+        point_group = PointGroup(PGname, Sym_ops, settings)
 
-def gather_csm(eig_file, name, spin_i, bands, Sym_ops, PGname, folder_path_out, settings):
+    ch_list, deg, en_deg, occ_deg = get_character(eig_file,folder_path_out,name,settings, spin_i, bands, point_group.permutation, overlaps)
+
+    return deg, np.array(ch_list[1:], dtype=complex).reshape(len(deg), len(point_group.mult))
+
+def gather_csm(eig_file, name, spin_i, bands, Sym_ops, PGname, folder_path_out, settings, overlaps=None, point_group=None):
     """
     Finds csm for considered bands
     Input:
@@ -345,6 +311,8 @@ def gather_csm(eig_file, name, spin_i, bands, Sym_ops, PGname, folder_path_out,
         PGname: string with name of point group
         folder_path_out: path of output directory
         settings: settings dicitonary
+        overlaps: OverlapResult, read from the overlap files if not given
+        point_group: PointGroup, built here if not given
     Returns:
         csm_array
         irreps
@@ -352,22 +320,18 @@ def gather_csm(eig_file, name, spin_i, bands, Sym_ops, PGname, folder_path_out,
 
     irrep_tol = settings['IR_tolerance']
 
-    ch_table, pos_vector = get_character_table(PGname,settings)
+    if point_group is None:
+        point_group = PointGroup(PGname, Sym_ops, settings)
 
-    perm, mult = order_columns(Sym_ops, name, settings, ch_table)
+    deg, chars = gather_characters(eig_file, name, spin_i, bands, Sym_ops, PGname, folder_path_out, settings, overlaps, point_group)
+    irr, csm = point_group.projector.irreps_and_csm(chars, irrep_tol)
 
-    ch_list, deg, en_deg, occ_deg = get_character(eig_file,folder_path_out,name,settings, spin_i, bands, perm)
-
-    irreps = [ch[0] for ch in ch_table[1:]]
-    irreps = get_irrep_symbols(ch_table)
-    csm_array = []
-
-    for i in range(len(deg)):
-        csm_array.append([deg[i], get_csm(ch_table, ch_list[1+i], mult, irrep_tol)])
+    irreps = get_irrep_symbols(point_group.ch_table)
+    csm_array = [[deg[i], csm_to_list(csm[i])] for i in range(len(deg))]
 
     return csm_array, irreps
 
-def csm_main(s1bands, s2bands, PGname, Sym_ops, settings, eig_file = "EIGENVAL",  name="", folder_path_out=""):
+def csm_main(s1bands, s2bands, PGname, Sym_ops, settings, eig_file = "EIGENVAL",  name="", folder_path_out="", overlaps=None, point_group=None):
     """
     Calculates csm and writes to a file.
     Input:
@@ -380,6 +344,9 @@ def csm_main(s1bands, s2bands, PGname, Sym_ops, settings, eig_file = "EIGENVAL",
         eig_file: string that is the path to a EIGENVAL file
         name: string with name (numbering) of defect
         folder_path_out: string that is the path to output directory
+        overlaps: OverlapResult of spin up and down, read from the
+                  overlap files if not given
+        point_group: PointGroup, built here if not given
     Returns:
 
     """
@@ -390,11 +357,23 @@ def csm_main(s1bands, s2bands, PGname, Sym_ops, settings, eig_file = "EIGENVAL",
     csm_array_s2 = []
     name2 = name+"_S2"
 
-    if len(s1bands) > 0:
-        csm_array_s1, irreps = gather_csm(eig_file, name1, 1, s1bands, Sym_ops, PGname, folder_path_out, settings)
+    if overlaps is None:
+        overlaps = [None, None]
+    if point_group is None:
+        point_group = PointGroup(PGname, Sym_ops, settings)
 
+    # The levels of both spins are projected together
+    deg_s1, chars_s1 = [], np.zeros((0, len(point_group.mult)), dtype=complex)
+    deg_s2, chars_s2 = [], np.zeros((0, len(point_group.mult)), dtype=complex)
+    if len(s1bands) > 0:
+        deg_s1, chars_s1 = gather_characters(eig_file, name1, 1, s1bands, Sym_ops, PGname, folder_path_out, settings, overlaps[0], point_group)
     if len(s2bands) > 0:
-        csm_array_s2, irreps = gather_csm(eig_file, name2, 2, s2bands, Sym_ops, PGname, folder_path_out, settings)
+        deg_s2, chars_s2 = gather_characters(eig_file, name2, 2, s2bands, Sym_ops, PGname, folder_path_out, settings, overlaps[1], point_group)
+
+    irr, csm = point_group.projector.irreps_and_csm(np.concatenate([chars_s1, chars_s2]), settings['IR_tolerance'])
+    irreps = get_irrep_symbols(point_group.ch_table)
+    csm_array_s1 = [[deg_s1[i], csm_to_list(csm[i])] for i in range(len(deg_s1))]
+    csm_array_s2 = [[deg_s2[i], csm_to_list(csm[len(deg_s1)+i])] for i in range(len(deg_s2))]
 
     csm_path = os.path.join(folder_path_out,"CSM"+name+".txt")
     file = open(csm_path,"w+")
@@ -427,12 +406,16 @@ def csm_main(s1bands, s2bands, PGname, Sym_ops, settings, eig_file = "EIGENVAL",
     file.close()
     return 0
 
-def get_allowed_transitions(char_table, position_vecs, char_list, multiplicity, bands_by_degen, eigen_by_bands, occ_by_degen, settings):
+def get_allowed_transitions(char_table, position_vecs, char_list, multiplicity, bands_by_degen, eigen_by_bands, occ_by_degen, settings, irreps=None, projector=None):
     """
     Takes table of characters and calculates the representation of each possible
     transition for each polarisation. Checks if representation contains
     identity representation.
 
+    The characters of all (initial, final, polarisation) direct products
+    are built as one array and projected onto the irreps together, strings
+    are only formatted for the transitions that are returned.
+
     Input:
         char_table: character table as numpy array
         position_vecs: characters of linear functions read from character tables
@@ -442,6 +425,8 @@ def get_allowed_transitions(char_table, position_vecs, char_list, multiplicity,
         eigen_by_bands: eigenvalues of each band, according to above order
         occ_by_degen: occupation of each band, according to above order
         settings: settings dicitonary
+        irreps: irreps of each level, computed here if not given
+        projector: IrrepProjector of the character table, built here if not given
     Returns:
         Array with information on each transition
         list of bands where no irrep was found
@@ -451,13 +436,15 @@ def get_allowed_transitions(char_table, position_vecs, char_list, multiplicity,
     tdm_IR_from_IR = settings['tdm_IR_from_IR']
     ch_list = char_list[1:]
     irr_symbols = get_irrep_symbols(char_table)
-    irreps = []
     no_irr = []
 
+    if projector is None:
+        projector = IrrepProjector.from_table(char_table, multiplicity)
+    if irreps is None:
+        irreps = projector.irreps_and_csm(ch_list, irrep_tol)[0].tolist()
+
     for i, ch in enumerate(ch_list):
-        irr = get_rep(char_table,ch,multiplicity,irrep_tol)
-        irreps.append(irr)
-        irr = np.array(irr)
+        irr = np.array(irreps[i])
         if np.sum(irr*irr) == 0:
             for band in bands_by_degen[i]:
                 no_irr.append(band)
@@ -465,34 +452,173 @@ def get_allowed_transitions(char_table, position_vecs, char_list, multiplicity,
         if tdm_IR_from_IR:
             ch_list[i] = np.array([round(np.real(c)) for c in ch])
 
+    n_levels = len(ch_list)
+    n_classes = len(multiplicity)
+    chars = np.array(ch_list, dtype=complex).reshape(n_levels, n_classes)
+    # The TDM characters are complex only if one of the levels is
+    is_complex = np.array([np.iscomplexobj(np.asarray(ch)) for ch in ch_list], dtype=bool)
+    pos_v = np.array([np.asarray(pos_vec[0][1:],float) for pos_vec in position_vecs], dtype=float).reshape(len(position_vecs), n_classes)
+
+    # Pairs of levels considered, in the order initial, final
+    occ = np.array(occ_by_degen[:n_levels], dtype=float)
+    n_deg = np.array([len(b) for b in bands_by_degen[:n_levels]], dtype=float)
+    pair_mask = (0 < occ)[:, None] & (occ < n_deg)[None, :] & ~np.eye(n_levels, dtype=bool)
+    init, final = np.nonzero(pair_mask)
+
+    # Characters of the direct products, shape (n_pairs, n_polarisations, n_classes)
+    tdm_chars = (pos_v[None, :, :] * chars[init][:, None, :]) * chars[final][:, None, :]
+    n_irr = len(projector.characters)
+    tdm_irreps = np.zeros((len(init), len(position_vecs), n_irr), dtype=int)
+    lookup = np.zeros(len(init), dtype=bool)
+
+    if tdm_IR_from_IR and n_irr > 0:
+        # Levels whose rounded characters are exactly those of their irreps
+        # get the TDM irreps from the direct product table of the point group
+        irr_arr = np.array(irreps, dtype=int).reshape(n_levels, n_irr)
+        exact = np.all(chars == irr_arr.dot(projector.characters), axis=1) & np.any(irr_arr != 0, axis=1)
+        lookup = exact[init] & exact[final]
+        table = projector.product_table(pos_v, irrep_tol)
+        tdm_irreps[lookup] = np.einsum('na,nb,abpc->npc', irr_arr[init[lookup]], irr_arr[final[lookup]], table)
+
+    if len(position_vecs) > 0 and not np.all(lookup):
+        rest_irreps, rest_csm = projector.irreps_and_csm(tdm_chars[~lookup].reshape(-1, n_classes), irrep_tol)
+        tdm_irreps[~lookup] = rest_irreps.reshape(-1, len(position_vecs), n_irr)
+
+    irr_strings = [get_total_irrep_string(irr_symbols,irr) for irr in irreps]
+
     transitions = []
 
-    for i, ch_init in enumerate(ch_list):
+    for n, (i, j) in enumerate(zip(init, final)):
+        for p, pos_vec in enumerate(position_vecs):
+            tdm_irr = tdm_irreps[n, p].tolist()
 
-        for j, ch_final in enumerate(ch_list):
+            # For saving
+            tdm = tdm_chars[n, p] if is_complex[i] or is_complex[j] else tdm_chars[n, p].real
+            tdm = tdm.tolist()
 
-            #if i < j:
-            if i != j and 0 < occ_by_degen[i] and occ_by_degen[j] < len(bands_by_degen[j]):
-                for pos_vec in position_vecs:
-                    pos_v = np.asarray(pos_vec[0][1:],float)
+            allowed = bool(tdm_irr[0] >= 1)
 
-                    tdm = ch_final * (pos_v * ch_init)
+            transitions.append([bands_by_degen[i], eigen_by_bands[i], irr_strings[i], \
+            bands_by_degen[j], eigen_by_bands[j], irr_strings[j], \
+            pos_vec[1], pos_vec[0][0], tdm, get_total_irrep_string(irr_symbols,tdm_irr), \
+            allowed])
 
-                    tdm_irr = get_rep(char_table, tdm, multiplicity,irrep_tol)
+    return transitions, no_irr
 
-                    # For saving
-                    tdm = tdm.tolist()
+def find_no_irrep(eig_file, name, spin_i, bands, Sym_ops, PGname, settings, overlaps, point_group=None):
+    """
+    Finds the bands where no irrep was found, without writing any output.
+    Used to recheck only the degenerate levels that got new centers.
+    Input:
+        eig_file: path to EIGENVAL file
+        name: string with name
+        spin_i: 1 or 2 for spin up or down
+        bands: list of band indices, whole degenerate levels
+        Sym_ops: array with symmetry operator info,
+                 output for get_symmetry_operators()
+        PGname: string with name of point group
+        settings: settings dicitonary
+        overlaps: OverlapResult of the bands
+        point_group: PointGroup, built here if not given
+    Returns:
+        list of bands where no irrep was found
+    """
 
-                    bool = (tdm_irr[0] >= 1)
+    irrep_tol = settings['IR_tolerance']
 
-                    transitions.append([bands_by_degen[i], eigen_by_bands[i], get_total_irrep_string(irr_symbols,irreps[i]), \
-                    bands_by_degen[j], eigen_by_bands[j], get_total_irrep_string(irr_symbols,irreps[j]), \
-                    pos_vec[1], pos_vec[0][0], tdm, get_total_irrep_string(irr_symbols,tdm_irr), \
-                    bool])
+    if point_group is None:
+        point_group = PointGroup(PGname, Sym_ops, settings)
+    ch_table, pos_vector = point_group.ch_table, point_group.pos_vector
+    perm, mult = point_group.permutation, point_group.mult
 
-    return transitions, no_irr
+    ch_list, deg, en_deg, occ_deg = get_character(eig_file,"",name,settings, spin_i,bands,perm, overlaps)
+
+    irr, csm = point_group.projector.irreps_and_csm(ch_list[1:], irrep_tol)
+
+    no_irr = []
+    for i in range(len(deg)):
+        if np.sum(irr[i]*irr[i]) == 0:
+            for band in deg[i]:
+                no_irr.append(band)
+    return no_irr
+
+def replace_bad_centers_by_csm(wf_file, eig_file, name, spin_i, bands, no_irr, candidates, overlaps, Sym_ops, PGname, folder_path_out, settings, point_group=None):
+    """
+    Evaluates all candidate centers for the degenerate levels where no
+    irrep was found, and gives each level the candidate with the lowest CSM.
+    The overlaps of these levels are replaced in place, and the centers and
+    the symmetry analysis are written again.
+    Input:
+        wf_file: string that is the path to a WAVECAR file, or a WavecarSession
+        eig_file: path to EIGENVAL file
+        name: string with name
+        spin_i: 1 or 2 for spin up or down
+        bands: list of band indices
+        no_irr: list of band indices where the center gave no irrep
+        candidates: list of candidate centers, from get_candidate_centers()
+        overlaps: OverlapResult of the bands
+        Sym_ops: array with symmetry operator info,
+                 output for get_symmetry_operators()
+        PGname: string with name of point group
+        folder_path_out: path of output directory
+        settings: settings dicitonary
+        point_group: PointGroup, built here if not given
+    Returns:
+        list of bands where no irrep was found
+    """
+
+    if len(candidates) == 0:
+        return no_irr
+
+    irrep_tol = settings['IR_tolerance']
 
-def analyse_symmetry(eig_file, name, spin_i, bands, Sym_ops, PGname, folder_path_out, settings):
+    if point_group is None:
+        point_group = PointGroup(PGname, Sym_ops, settings)
+    ch_table, pos_vector = point_group.ch_table, point_group.pos_vector
+    perm, mult = point_group.permutation, point_group.mult
+
+    retry_bands = [band for band in bands if band in no_irr]
+    bands_by_degen, band_en_by_degen, band_occ_by_degen = get_energy_and_band_degen(eig_file,spin_i,retry_bands,settings)
+    cand_ov = get_candidate_overlaps(wf_file, spin_i, retry_bands, candidates, Sym_ops, settings)
+
+    c_path = os.path.join(folder_path_out,"Centers_"+name)
+    centers = np.load(c_path+".npy")
+    file = open(c_path+".txt","a+")
+    file.write("Bad center switched to (lowest CSM): \n")
+
+    result = []
+    for deg_bands in bands_by_degen:
+        rows = [retry_bands.index(int(band)) for band in deg_bands]
+        level_ov = cand_ov[:, rows].sum(axis=1)
+        class_ov = np.array([[row[l].mean() for l in perm] for row in level_ov])
+
+        irr, csm = point_group.projector.irreps_and_csm(class_ov, irrep_tol)
+        # Rounded first, so noise like -0.04 counts as 0 and only
+        # the -404 of complex projections is left out
+        csm = np.round(csm, 1) + 0.0
+        best_csm = np.where(csm >= 0, csm, np.inf).min(axis=1, initial=np.inf)
+        best = int(np.argmin(best_csm))
+
+        if np.isinf(best_csm[best]):
+            # No candidate gave a real projection, the level keeps its center
+            for band in deg_bands:
+                file.write(str(band)+"   no candidate with a valid CSM, center kept\n")
+            continue
+
+        for band, row in zip(deg_bands, rows):
+            centers[bands.index(int(band))] = candidates[best]
+            file.write(str(band)+"   "+str(candidates[best])+"   CSM: "+str(best_csm[best])+"\n")
+            result.append([[spin_i,1,int(band)], [np.real_if_close(ov).tolist() for ov in cand_ov[best, row]]])
+    file.close()
+    np.save(c_path+".npy", centers)
+
+    if len(result) > 0:
+        overlaps.replace_bands(OverlapResult.from_list(name, PGname, overlaps.symmetry_operators, result))
+        write_overlaps_async(overlaps, folder_path_out, settings)
+
+    return analyse_symmetry(eig_file, name, spin_i, bands, Sym_ops, PGname, folder_path_out, settings, overlaps, point_group)
+
+def analyse_symmetry(eig_file, name, spin_i, bands, Sym_ops, PGname, folder_path_out, settings, overlaps=None, point_group=None):
     """
     Finds characters and irreps of the considered bands,
     finds allowed transitions and writes this to a file,
@@ -508,17 +634,20 @@ def analyse_symmetry(eig_file, name, spin_i, bands, Sym_ops, PGname, folder_path
         PGname: string with name of point group
         folder_path_out: path of output directory
         settings: settings dicitonary
+        overlaps: OverlapResult, read from the overlap files if not given
+        point_group: PointGroup, built here if not given
     Returns:
         list of bands where no irrep was found
     """
 
     irrep_tol = settings['IR_tolerance']
 
-    ch_table, pos_vector = get_character_table(PGname,settings)
-
-    perm, mult = order_columns(Sym_ops, name, settings, ch_table)
+    if point_group is None:
+        point_group = PointGroup(PGname, Sym_ops, settings)
+    ch_table, pos_vector = point_group.ch_table, point_group.pos_vector
+    perm, mult = point_group.permutation, point_group.mult
 
-    ch_list, deg, en_deg, occ_deg = get_character(eig_file,folder_path_out,name,settings, spin_i,bands,perm)
+    ch_list, deg, en_deg, occ_deg = get_character(eig_file,folder_path_out,name,settings, spin_i,bands,perm, overlaps)
 
     print(ch_list)
     pprint(deg)
@@ -538,9 +667,12 @@ def analyse_symmetry(eig_file, name, spin_i, bands, Sym_ops, PGname, folder_path
 
     band_info = []
 
+    irr_symbols = get_irrep_symbols(ch_table)
+    level_irreps, level_csm = point_group.projector.irreps_and_csm(ch_list[1:], irrep_tol)
+
     for i in range(len(deg)):
 
-        tot_irr_string = get_total_irrep_string(get_irrep_symbols(ch_table),get_rep(ch_table, ch_list[1+i], mult,irrep_tol))
+        tot_irr_string = get_total_irrep_string(irr_symbols,level_irreps[i].tolist())
         print(i, deg[i], ch_list[1+i], tot_irr_string)
         #file.write(str(deg[i])+"   "+str(en_deg[i])+"   "+str(occ_deg[i])+"   "+str(ch_list[1+i])+"   "+tot_irr_string+"\n")
         file.write(f"{str(deg[i]):<15} {en_deg[i]:<10} {occ_deg[i]:<5} {tot_irr_string:<5} {ch_list[1+i]}\n")
@@ -548,7 +680,7 @@ def analyse_symmetry(eig_file, name, spin_i, bands, Sym_ops, PGname, folder_path
 
 
 
-    tr, no_irr = get_allowed_transitions(ch_table, pos_vector, ch_list, mult, deg, en_deg, occ_deg, settings)
+    tr, no_irr = get_allowed_transitions(ch_table, pos_vector, ch_list, mult, deg, en_deg, occ_deg, settings, level_irreps.tolist(), point_group.projector)
     #pprint(tr)
 
     #tr_array = np.asanyarray([PGname, band_info, tr],dtype=object)
@@ -576,7 +708,7 @@ def analyse_symmetry(eig_file, name, spin_i, bands, Sym_ops, PGname, folder_path
     return no_irr
 
 
-def main(s1bands, s2bands, pos_file = "CONTCAR", wf_file = "WAVECAR", eig_file = "EIGENVAL", name="", settings_file = "settings.json", folder_path_out=""):
+def main(s1bands, s2bands, pos_file = "CONTCAR", wf_file = "WAVECAR", eig_file = "EIGENVAL", name="", settings_file = "settings.json", folder_path_out="", workers=1):
     """
     Main function of ADAQ-SYM.
     Performs overlap calculation for considerd bands, followed by symmetry
@@ -586,11 +718,12 @@ def main(s1bands, s2bands, pos_file = "CONTCAR", wf_file = "WAVECAR", eig_file =
         s1bands: list of band indices for spin channel 1
         s2bands: list of band indices for spin channel 2
         pos_file: string that is the path to a crystal structure file like POSCAR or CONTCAR
-        wf_file: string that is the path to a WAVECAR file
+        wf_file: string that is the path to a WAVECAR file, or a WavecarSession
         eig_file: string that is the path to a EIGENVAL file
         name: string with name (numbering) of defect
         settings_file: string that is the path to a json file
         folder_path_out: string that is the path to output directory
+        workers: number of processes used for centers and overlaps
     Returns:
 
     """
@@ -608,10 +741,32 @@ def main(s1bands, s2bands, pos_file = "CONTCAR", wf_file = "WAVECAR", eig_file =
         spglib = get_spglib()
         globals()["spglib"] = spglib
     
-    PGname, Sym_ops = get_symmetry_operators(sym, pos_file, settings)
+    # Results of earlier runs with identical inputs are reused from the cache
+    cache = open_cache(settings, folder_path_out)
+
+    sym_key = None
+    sym_data = None
+    if cache is not None:
+        sym_key = cache.key("symmetry", file_fingerprint(pos_file), settings['aflow_tolerance'],
+                            character_tables_fingerprint(settings['char_table_dir']))
+        sym_data = cache.load_json(sym_key)
+    if sym_data is None:
+        PGname, Sym_ops = get_symmetry_operators(sym, pos_file, settings)
+        if cache is not None:
+            cache.save_json(sym_key, {"point_group": PGname, "symmetry_operators": Sym_ops})
+    else:
+        PGname, Sym_ops = sym_data["point_group"], sym_data["symmetry_operators"]
+        print("Loaded symmetry operators from cache!")
     print("Point group: ",PGname)
     print(Sym_ops)
 
+    # Classes, character table and position vector representation are
+    # only worked out once
+    point_group = PointGroup(PGname, Sym_ops, settings)
+
+    # Open the WAVECAR once and share it between all stages
+    wf_file = open_wavecar(wf_file, lgamma=settings['Gammapoint_calc'])
+
     # Initial overlap and analysis for spin up channel
     no_irr_s1 = []
     if len(s1bands) > 0:
@@ -619,17 +774,11 @@ def main(s1bands, s2bands, pos_file = "CONTCAR", wf_file = "WAVECAR", eig_file =
 
         bands_by_degen_s1, band_en_by_degen_s1, band_occ_by_degen_s1 = get_energy_and_band_degen(eig_file,1,s1bands,settings)
         print("Spin up orbitals by degeneracy: ", bands_by_degen_s1)
-        try:
-            center_path = os.path.join(folder_path_out,"Centers_"+name1+".npy")
-            centers_s1 = np.load(center_path)
-            print("Loaded centers!")
-        except Exception as e:
-            centers_s1 = get_orbital_centers(wf_file, bands_by_degen_s1, name1, 1, folder_path_out, settings)
-            print("Calculated new centers!")
+        centers_s1 = get_orbital_centers(wf_file, bands_by_degen_s1, name1, 1, folder_path_out, settings, workers=workers, cache=cache, Sym_ops=Sym_ops, pos_file=pos_file)
         print("Spin 1")
-        res1 = get_overlaps_of_bands(wf_file, name1, 1, s1bands, centers_s1, PGname, Sym_ops, folder_path_out, settings)
+        res1 = get_overlaps_of_bands(wf_file, name1, 1, s1bands, centers_s1, PGname, Sym_ops, folder_path_out, settings, workers=workers, cache=cache)
         #write_overlaps_to_text(res1, folder_path_out, name1)
-        no_irr_s1 = analyse_symmetry(eig_file, name1, 1, s1bands, Sym_ops, PGname, folder_path_out, settings)
+        no_irr_s1 = analyse_symmetry(eig_file, name1, 1, s1bands, Sym_ops, PGname, folder_path_out, settings, res1, point_group)
         good_centers_s1 = get_good_centers(name1, s1bands, no_irr_s1, folder_path_out)
 
     # Initial overlap and analysis for spin down channel
@@ -639,60 +788,87 @@ def main(s1bands, s2bands, pos_file = "CONTCAR", wf_file = "WAVECAR", eig_file =
 
         bands_by_degen_s2, band_en_by_degen_s2, band_occ_by_degen_s2 = get_energy_and_band_degen(eig_file,2,s2bands,settings)
         print("Spin down orbitals by degeneracy: ", bands_by_degen_s2)
-        try:
-            center_path = os.path.join(folder_path_out,"Centers_"+name2+".npy")
-            centers_s2 = np.load(center_path)
-            print("Loaded centers!")
-        except Exception as e:
-            centers_s2 = get_orbital_centers(wf_file, bands_by_degen_s2, name2, 2, folder_path_out, settings)
-            print("Calculated new centers!")
+        centers_s2 = get_orbital_centers(wf_file, bands_by_degen_s2, name2, 2, folder_path_out, settings, workers=workers, cache=cache, Sym_ops=Sym_ops, pos_file=pos_file)
         print("Spin 2")
-        res2 = get_overlaps_of_bands(wf_file, name2, 2, s2bands, centers_s2, PGname, Sym_ops, folder_path_out, settings)
+        res2 = get_overlaps_of_bands(wf_file, name2, 2, s2bands, centers_s2, PGname, Sym_ops, folder_path_out, settings, workers=workers, cache=cache)
         #write_overlaps_to_text(res2, folder_path_out, name2)
-        no_irr_s2 = analyse_symmetry(eig_file, name2, 2, s2bands, Sym_ops, PGname, folder_path_out, settings)
+        no_irr_s2 = analyse_symmetry(eig_file, name2, 2, s2bands, Sym_ops, PGname, folder_path_out, settings, res2, point_group)
         good_centers_s2 = get_good_centers(name2, s2bands, no_irr_s2, folder_path_out)
 
 
 
-    # Gather good centers, add additional center candidates, e.g. impurity position
-    #good_centers = np.array([])
-    if len(s1bands) > 0 and len(s2bands) > 0:
-        good_centers = np.append(good_centers_s1, good_centers_s2, axis=0)
-        #good_centers = np.append(good_centers, good_centers_s2, axis=0)
-
-    defect_pos = get_single_species(pos_file)
-    if defect_pos != None:
-        good_centers = np.array([defect_pos])
-    good_centers_s1 = good_centers
-    good_centers_s2 = good_centers
-
-
-    # Redo overlap and analysis with new centers if no irrep was found
+    if settings['center_replacement'] == "batched":
+        # All candidate centers are evaluated for the levels without irrep
+        # in one pass, and the one with the lowest CSM is used
+        known_centers = []
+        if len(s1bands) > 0:
+            known_centers += list(good_centers_s1)
+        if len(s2bands) > 0:
+            known_centers += list(good_centers_s2)
+        candidates = get_candidate_centers(pos_file, Sym_ops, known_centers)
+        if len(no_irr_s1) > 0:
+            no_irr_s1 = replace_bad_centers_by_csm(wf_file, eig_file, name1, 1, s1bands, no_irr_s1, candidates, res1, Sym_ops, PGname, folder_path_out, settings, point_group)
+        if len(no_irr_s2) > 0:
+            no_irr_s2 = replace_bad_centers_by_csm(wf_file, eig_file, name2, 2, s2bands, no_irr_s2, candidates, res2, Sym_ops, PGname, folder_path_out, settings, point_group)
+    else:
+        # Gather good centers, add additional center candidates, e.g. impurity position
+        #good_centers = np.array([])
+        if len(s1bands) > 0 and len(s2bands) > 0:
+            good_centers = np.append(good_centers_s1, good_centers_s2, axis=0)
+            #good_centers = np.append(good_centers, good_centers_s2, axis=0)
+
+        defect_pos = get_single_species(pos_file)
+        if defect_pos != None:
+            good_centers = np.array([defect_pos])
+        good_centers_s1 = good_centers
+        good_centers_s2 = good_centers
+
+
+        # Redo overlap and analysis with new centers if no irrep was found
+
+        # Only the degenerate levels without irrep are recomputed and rechecked
+        retried = False
+        while 0 < len(no_irr_s1) and 0 < len(good_centers_s1):
+            good_centers_s1, centers_s1 = replace_bad_centers(name1, s1bands, no_irr_s1, good_centers_s1, folder_path_out)
+            retry_bands = [band for band in s1bands if band in no_irr_s1]
+            retry_centers = [centers_s1[s1bands.index(band)] for band in retry_bands]
+            retry_res = get_overlaps_of_bands(wf_file, name1, 1, retry_bands, retry_centers, PGname, Sym_ops, folder_path_out, settings, workers=workers, cache=cache, write=False)
+            res1.replace_bands(retry_res)
+            no_irr_s1 = find_no_irrep(eig_file, name1, 1, retry_bands, Sym_ops, PGname, settings, retry_res, point_group)
+            retried = True
+        if retried:
+            write_overlaps_async(res1, folder_path_out, settings)
+            no_irr_s1 = analyse_symmetry(eig_file, name1, 1, s1bands, Sym_ops, PGname, folder_path_out, settings, res1, point_group)
+        # Redo overlap and analysis with new centers if no irrep was found
+        #if  0 < len(no_irr_s2) < len(s2bands):
+
+        # Only the degenerate levels without irrep are recomputed and rechecked
+        retried = False
+        while 0 < len(no_irr_s2) and 0 < len(good_centers_s2):
+            good_centers_s2, centers_s2 = replace_bad_centers(name2, s2bands, no_irr_s2, good_centers_s2, folder_path_out)
+            retry_bands = [band for band in s2bands if band in no_irr_s2]
+            retry_centers = [centers_s2[s2bands.index(band)] for band in retry_bands]
+            retry_res = get_overlaps_of_bands(wf_file, name2, 2, retry_bands, retry_centers, PGname, Sym_ops, folder_path_out, settings, workers=workers, cache=cache, write=False)
+            res2.replace_bands(retry_res)
+            no_irr_s2 = find_no_irrep(eig_file, name2, 2, retry_bands, Sym_ops, PGname, settings, retry_res, point_group)
+            retried = True
+        if retried:
+            write_overlaps_async(res2, folder_path_out, settings)
+            no_irr_s2 = analyse_symmetry(eig_file, name2, 2, s2bands, Sym_ops, PGname, folder_path_out, settings, res2, point_group)
 
-    while 0 < len(no_irr_s1) and 0 < len(good_centers_s1):
-        good_centers_s1, centers_s1 = replace_bad_centers(name1, s1bands, no_irr_s1, good_centers_s1, folder_path_out)
-        res1 = get_overlaps_of_bands(wf_file, name1, 1, s1bands, centers_s1, PGname, Sym_ops, folder_path_out, settings)
-        #write_overlaps_to_text(res1, folder_path_out, name1)
-        no_irr_s1 = analyse_symmetry(eig_file, name1, 1, s1bands, Sym_ops, PGname, folder_path_out, settings)
     if len(no_irr_s1) > 0:
         file = open("no_irr.txt","a+")
         file.write("Spin1: "+str(no_irr_s1)+"\n")
         file.close()
-    # Redo overlap and analysis with new centers if no irrep was found
-    #if  0 < len(no_irr_s2) < len(s2bands):
-
-    while 0 < len(no_irr_s2) and 0 < len(good_centers_s2):
-        good_centers_s2, centers_s2 = replace_bad_centers(name2, s2bands, no_irr_s2, good_centers_s2, folder_path_out)
-        res2 = get_overlaps_of_bands(wf_file, name2, 2, s2bands, centers_s2, PGname, Sym_ops, folder_path_out, settings)
-        #write_overlaps_to_text(res2, folder_path_out, name2)
-        no_irr_s2 = analyse_symmetry(eig_file, name2, 2, s2bands, Sym_ops, PGname, folder_path_out, settings)
     if len(no_irr_s2) > 0:
         file = open("no_irr.txt","a+")
         file.write("Spin2: "+str(no_irr_s2)+"\n")
         file.close()
 
-    write_overlaps_to_text_fancy(PGname, folder_path_out, name, settings)
-    csm_main(s1bands, s2bands, PGname, Sym_ops, settings, eig_file=eig_file, folder_path_out=folder_path_out)
+    overlaps = [res1 if len(s1bands) > 0 else None, res2 if len(s2bands) > 0 else None]
+    write_overlaps_to_text_fancy(PGname, folder_path_out, name, settings, overlaps, point_group)
+    csm_main(s1bands, s2bands, PGname, Sym_ops, settings, eig_file=eig_file, folder_path_out=folder_path_out, overlaps=overlaps, point_group=point_group)
+    flush_writes()
 
     return 0
 
@@ -0,0 +1,159 @@
+import os
+import json
+import hashlib
+from functools import lru_cache
+
+import numpy as np
+
+import backend
+
+CODE_FILES = ("analysis.py", "backend.py", "cache.py", "extract.py", "overlap.py")
+
+# Coefficients hashed at the start and end of each band record
+SAMPLE_COEFFS = 256
+
+@lru_cache(maxsize=None)
+def code_version():
+    """
+    Hash of the source files of ADAQ-SYM, so results from other versions of
+    the code are never reused.
+    """
+    h = hashlib.sha256()
+    folder = os.path.dirname(os.path.abspath(__file__))
+    for fname in CODE_FILES:
+        with open(os.path.join(folder, fname), "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def file_fingerprint(path):
+    """
+    Hash of the content of a (small) file, e.g. CONTCAR.
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def character_tables_fingerprint(char_table_dir):
+    """
+    Hash of the names and contents of the character tables (.lis files)
+    in char_table_dir, so edited tables give new cache keys.
+    """
+    h = hashlib.sha256()
+    if os.path.isdir(char_table_dir):
+        for fname in sorted(os.listdir(char_table_dir)):
+            if fname.endswith(".lis"):
+                h.update(fname.encode())
+                h.update(file_fingerprint(os.path.join(char_table_dir, fname)).encode())
+    return h.hexdigest()
+
+def _to_json(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return str(obj)
+
+def make_key(*parts):
+    """
+    Hash of any json serializable parts, numpy arrays are converted to lists.
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=_to_json).encode()).hexdigest()
+
+class ResultCache:
+    """
+    Content addressed store of intermediate results (symmetry data, centers
+    and overlaps). Every entry is keyed by a hash of all inputs it depends
+    on: WAVECAR header, size, modification time and samples of the band
+    records, CONTCAR, the relevant settings, the symmetry backend and the
+    code version. Changed inputs simply give a new key.
+
+    Input:
+        cache_dir: directory where the entries are stored
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self._band_hashes = {}
+
+    def wavecar_fingerprint(self, wav, spin, bands):
+        """
+        Hash of the WAVECAR header, its size and modification time, the
+        k-point record of the spin channel (eigenvalues and occupations) and
+        a sample of the first and last coefficients of each band record.
+        Only a few pages of the file are read, so a lookup costs much less
+        than reading the bands.
+
+        Input:
+            wav: WavecarSession
+            spin: 1 or 2 for spin up or down
+            bands: list of band indices
+        Returns:
+            hash as string
+        """
+        h = hashlib.sha256()
+        st = os.stat(wav.path)
+        h.update(str((st.st_size, st.st_mtime_ns)).encode())
+        h.update(wav._mmap[:2*wav._recl].tobytes())
+        kpoint_rec = wav.wav.whereRec(spin, 1, 1) - 1
+        h.update(wav._mmap[kpoint_rec*wav._recl:(kpoint_rec+1)*wav._recl].tobytes())
+        for band in bands:
+            key = (os.path.abspath(wav.path), spin, int(band))
+            if key not in self._band_hashes:
+                record = wav.band_record(spin, 1, int(band))
+                sample = np.concatenate([record[:SAMPLE_COEFFS], record[-SAMPLE_COEFFS:]])
+                self._band_hashes[key] = hashlib.sha256(sample.tobytes()).hexdigest()
+            h.update(self._band_hashes[key].encode())
+        return h.hexdigest()
+
+    def key(self, stage, *parts):
+        """
+        Key of an entry, including the backend and the code version.
+        """
+        return stage+"_"+make_key(stage, backend.backend_name(), code_version(), *parts)
+
+    def load_arrays(self, key):
+        """
+        Returns dictionary of arrays stored under key, None if not cached.
+        """
+        path = os.path.join(self.cache_dir, key+".npz")
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            return {k: data[k] for k in data.files}
+
+    def save_arrays(self, key, **arrays):
+        path = os.path.join(self.cache_dir, key+".npz")
+        tmp = path+".tmp.npz"
+        np.savez(tmp, **arrays)
+        os.replace(tmp, path)
+
+    def load_json(self, key):
+        """
+        Returns json data stored under key, None if not cached.
+        """
+        path = os.path.join(self.cache_dir, key+".json")
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def save_json(self, key, data):
+        path = os.path.join(self.cache_dir, key+".json")
+        tmp = path+".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f, default=_to_json)
+        os.replace(tmp, path)
+
+def open_cache(settings, folder_path_out=""):
+    """
+    Returns the ResultCache given by settings['cache_dir'], relative to the
+    output directory, or None if the cache is turned off (empty string, the
+    default).
+    """
+    cache_dir = settings['cache_dir']
+    if not cache_dir:
+        return None
+    return ResultCache(os.path.join(folder_path_out, cache_dir))
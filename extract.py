@@ -8,6 +8,10 @@ import subprocess
 import json
 import bz2
 import math as m
+import os
+import copy
+import zipfile
+import tempfile
 
 def get_schoenflies(W):
     """
@@ -291,6 +295,36 @@ def get_symmetry_operators(sym, pos_file, settings):
     
 
     ch_table, pos_vec_rep = get_character_table(PGname,settings)
+    class_perm2, mult_right_order = get_column_permutation(matrices1, symbols1, ch_table)
+
+    permutation = []
+    for cp2 in class_perm2:
+        for p in cp2:
+            permutation.append(p)
+    symbols = []
+    matrices = []
+    angle = []
+    axis = []
+
+    for i in permutation:
+        symbols.append(symbols1[i])
+        matrices.append(matrices1[i])
+        angle.append(angle1[i])
+        axis.append(axis1[i])
+
+    return PGname, [symbols, matrices, axis, angle]
+
+def get_class_order(ch_table):
+    """
+    Reads the classes and their multiplicities from the top line of a
+    character table.
+
+    Input:
+        ch_table: character table as array
+    Returns:
+        class symbols in the order of the columns
+        multiplicity (order) of each class
+    """
     class_symbols = ch_table[0][1:]
     mult_right_order = []
     classes_right_order = []
@@ -304,30 +338,140 @@ def get_symmetry_operators(sym, pos_file, settings):
             if not int_previous:
                 mult_right_order.append(1)
             int_previous = False
+    return classes_right_order, mult_right_order
+
+def get_column_permutation(sym_ops, symbols, ch_table):
+    """
+    Sorts the symmetry operators into the classes of the columns of a
+    character table.
+
+    Input:
+        sym_ops: array of symmetry operators (3x3 matrix)
+        symbols: array of symbols of each operator (e.g. C3, S2, i)
+        ch_table: character table as array
+    Returns:
+        indices of the operators of each column
+        multiplicity (order) of each column
+    """
+    classes_right_order, mult_right_order = get_class_order(ch_table)
 
-    class_symbols, class_perm, mult = sort_into_classes(matrices1, symbols1)
+    class_symbols, class_perm, mult = sort_into_classes(sym_ops, symbols)
 
     perm = get_class_permutation(classes_right_order, mult_right_order, class_symbols, mult)
-    
-    class_perm2 = []
-    for p in perm:
-        class_perm2.append(class_perm[p])
+
     permutation = []
-    for cp2 in class_perm2:
-        for p in cp2:
-            permutation.append(p)
-    symbols = []
-    matrices = []
-    angle = []
-    axis = []
+    for p in perm:
+        permutation.append(class_perm[p])
 
-    for i in permutation:
-        symbols.append(symbols1[i])
-        matrices.append(matrices1[i])
-        angle.append(angle1[i])
-        axis.append(axis1[i])
+    return permutation, mult_right_order
 
-    return PGname, [symbols, matrices, axis, angle]
+class PointGroup:
+    """
+    Symmetry bookkeeping of the point group: operators, classes, character
+    table and position vector representation. Built once per run and passed
+    to every analysis step.
+
+    Input:
+        PGname: name of point group
+        Sym_ops: array with symmetry operator info,
+                 output for get_symmetry_operators()
+        settings: settings dicitonary
+    """
+
+    def __init__(self, PGname, Sym_ops, settings):
+        self.name = PGname
+        self.Sym_ops = Sym_ops
+        self.operators = np.asarray(Sym_ops[1], dtype=float)
+        self.ch_table, self.pos_vector = get_character_table(PGname, settings)
+        self.class_symbols, self.classes, self.class_mult = sort_into_classes(Sym_ops[1], Sym_ops[0])
+        self.permutation = get_column_permutation(Sym_ops[1], Sym_ops[0], self.ch_table)[0]
+        self.irreps = [row[0] for row in self.ch_table[1:]]
+        self.characters, mult = get_character_arrays(PGname, settings)
+        self.mult = mult.tolist()
+        self.projector = IrrepProjector(self.characters, self.mult)
+
+class IrrepProjector:
+    """
+    Projects characters onto the irreps of a character table. The table is
+    stored weighted by the class multiplicities, so the projections of any
+    number of levels are one matrix product.
+
+    Input:
+        characters: characters of the irreps, shape (n_irreps, n_classes)
+        mult: multiplicity (order) of each class
+    """
+
+    def __init__(self, characters, mult):
+        mult = np.asarray(mult, dtype=float)
+        self.characters = np.asarray(characters, dtype=int).reshape(-1, len(mult))
+        self.weights = (self.characters * mult) / mult.sum()
+
+    @classmethod
+    def from_table(cls, ch_table, mult):
+        return cls([[int(r) for r in row[1:]] for row in ch_table[1:]], mult)
+
+    def project(self, chars):
+        """
+        Projections of characters onto each irrep.
+
+        Input:
+            chars: characters of each level, shape (n_levels, n_classes)
+        Returns:
+            array with projections, shape (n_levels, n_irreps)
+        """
+        chars = np.asarray(chars, dtype=complex).reshape(-1, self.weights.shape[1])
+        return chars.dot(self.weights.T)
+
+    def irreps_and_csm(self, chars, irrep_tol):
+        """
+        Irreps and continuous symmetry measure of each level.
+        A projection counts as irrep multiplicity if it is within irrep_tol
+        of an integer and its imaginary part is below irrep_tol. The CSM is
+        100*(1-projection), -404 if the imaginary part is too large.
+
+        Input:
+            chars: characters of each level, shape (n_levels, n_classes)
+            irrep_tol: tolerance
+        Returns:
+            array with multiplicity of each irrep, shape (n_levels, n_irreps)
+            array with CSM of each irrep, shape (n_levels, n_irreps)
+        """
+        proj = self.project(chars)
+        proj_r = proj.real
+        rounded = np.round(proj_r)
+        real = np.abs(proj.imag) <= irrep_tol
+        irreps = np.where(real & (np.abs(proj_r - rounded) < irrep_tol), rounded, 0).astype(int)
+        csm = np.where(real, 100*(1 - proj_r), -404)
+        return irreps, csm
+
+    def product_table(self, pos_v, irrep_tol):
+        """
+        Irrep decomposition of every direct product irrep_a x polarisation x
+        irrep_b, computed once per character table and set of polarisations.
+
+        Input:
+            pos_v: characters of each polarisation, shape (n_pol, n_classes)
+            irrep_tol: tolerance
+        Returns:
+            array with multiplicity of each irrep, shape (n_irreps, n_irreps, n_pol, n_irreps)
+        """
+        pos_v = np.asarray(pos_v, dtype=float).reshape(-1, self.weights.shape[1])
+        key = (self.characters.tobytes(), self.weights.tobytes(), pos_v.tobytes(), irrep_tol)
+        if key not in _product_tables:
+            n_irr = len(self.characters)
+            chars = self.characters.astype(float)
+            products = (pos_v[None, :, :] * chars[:, None, :])[:, None, :, :] * chars[None, :, None, :]
+            irreps, csm = self.irreps_and_csm(products.reshape(-1, chars.shape[1]), irrep_tol)
+            _product_tables[key] = irreps.reshape(n_irr, n_irr, len(pos_v), n_irr)
+        return _product_tables[key]
+
+_product_tables = {}
+
+def csm_to_list(csm):
+    """
+    CSM of one level as list, rounded to one decimal, -404 as integer.
+    """
+    return [-404 if c == -404 else round(float(c), 1) for c in csm]
 
 def get_class_permutation(classes_right_order, mult_right_order, class_symbols, mult):
 
@@ -351,6 +495,70 @@ def get_class_permutation(classes_right_order, mult_right_order, class_symbols,
                 perm.append(ind)
     return perm
 
+class GroupTables:
+    """
+    Multiplication, inverse and conjugation tables of a group of symmetry
+    operators, as operator indices. Operators are matched within a
+    tolerance, so the tables are exact also for floating point matrices.
+
+    Input:
+        sym_ops: array of symmetry operators (3x3 matrix)
+        tol: largest accepted difference of any matrix element
+    """
+
+    def __init__(self, sym_ops, tol=1e-6):
+        ops = np.asarray(sym_ops, dtype=float).reshape(-1, 3, 3)
+        n = len(ops)
+        self.ops = ops
+        self.tol = tol
+
+        # mult[i, j] is the index of ops[i] ops[j]
+        products = np.einsum('iab,jbc->ijac', ops, ops).reshape(n*n, 9)
+        self.mult = self.match(products).reshape(n, n)
+        self.inverse = self.match(np.linalg.inv(ops).reshape(n, 9))
+
+        # conj[i, x] is the index of ops[x]^-1 ops[i] ops[x]
+        x = np.arange(n)
+        inner = self.mult[self.inverse[:, None], x[None, :]]
+        self.conj = self.mult[inner, x[:, None]].T
+
+    def match(self, matrices):
+        """
+        Index of the operator equal to each (flattened) matrix.
+        """
+        diff = np.abs(matrices[:, None, :] - self.ops.reshape(1, -1, 9)).max(axis=2)
+        index = np.argmin(diff, axis=1)
+        if np.any(diff[np.arange(len(index)), index] > self.tol):
+            raise ValueError("The symmetry operators do not form a group.")
+        return index
+
+    def classes(self):
+        """
+        Conjugacy classes, each starting with its first operator followed
+        by the other members in increasing order.
+        """
+        classes = []
+        used = np.zeros(len(self.ops), dtype=bool)
+        for i in range(len(self.ops)):
+            if not used[i]:
+                members = np.unique(self.conj[i])
+                members = members[(members != i) & ~used[members]]
+                used[i] = True
+                used[members] = True
+                classes.append([i] + members.tolist())
+        return classes
+
+_group_tables = {}
+
+def get_group_tables(sym_ops, tol=1e-6):
+    """
+    Returns the GroupTables of the operators, built once per operator set.
+    """
+    key = np.round(np.asarray(sym_ops, dtype=float), 6).tobytes()
+    if key not in _group_tables:
+        _group_tables[key] = GroupTables(sym_ops, tol)
+    return _group_tables[key]
+
 def sort_into_classes(sym_ops, symbols):
     """
     Sorts symmetry operators into conjugacy classes,
@@ -363,26 +571,9 @@ def sort_into_classes(sym_ops, symbols):
         class_perm: array with permutation of the operators into the classes
         mult: array with multiplicity (order) of each class
     """
-    class_symbols = []
-    class_perm = []
-    used = []
-
-    for i, A in enumerate(sym_ops):
-        if i not in used:
-            cls_perm = [i]
-            class_symbols.append(symbols[i])
-            used.append(i)
-            for j, B in enumerate(sym_ops):
-                for X in sym_ops:
-                    conj = np.linalg.inv(X).dot(np.array(A).dot(X))
-                    if np.all(B == conj) and j not in used:
-                        cls_perm.append(j)
-                        used.append(j)
-            class_perm.append(cls_perm)
-
-    mult = []
-    for i in class_perm:
-        mult.append(len(i))
+    class_perm = get_group_tables(sym_ops).classes()
+    class_symbols = [symbols[cls_perm[0]] for cls_perm in class_perm]
+    mult = [len(cls_perm) for cls_perm in class_perm]
 
     return class_symbols, class_perm, mult
 
@@ -577,6 +768,58 @@ def find_average_position_shifted(realwf_array, procent, center):
 
     return np.array(avg_pos) % 1
 
+def find_circular_and_shifted_mean(realwf_array, procent, center=None, periodic=False):
+    """
+    Finds both the circular mean and the shifted average position of the
+    wavefunction in one pass over |psi|^2, the result is the same as
+    find_circular_mean_realspace_opt() followed by find_average_position_shifted().
+    |psi|^2 is accumulated in place and the means are taken from its 1D
+    projections on each axis, so no meshgrids are allocated.
+    Input:
+        realwf_array: array with realspace wavefuntions as output by vaspwfc.wfc_r
+        procent: sets psi=0 when |psi|^2 < max * procent
+        center: position used to shift the grid, default the circular mean
+        periodic: if True grid point i is at i/n, as in the FFT grid of
+                  vaspwfc.wfc_r, instead of i/(n-1)
+    Returns:
+        position of the circular mean in the lattice basis
+        average position
+    """
+    sh = realwf_array[0].shape
+    wf2_tot = np.zeros(sh)
+    wf2 = np.empty(sh)
+
+    for wf in realwf_array:
+        np.abs(wf, out=wf2)
+        np.square(wf2, out=wf2)
+        wf2_tot += wf2
+    del wf2
+
+    cutoff = np.max(wf2_tot)*procent
+    wf2_tot[wf2_tot <= cutoff] = 0
+    wf2_tot /= np.sum(wf2_tot)
+
+    projections = [wf2_tot.sum(axis=(1,2)), wf2_tot.sum(axis=(0,2)), wf2_tot.sum(axis=(0,1))]
+
+    grid_points = [np.arange(n)/n if periodic else np.arange(n)/(n-1) for n in sh]
+
+    circ_mean = []
+    for a, p in zip(grid_points, projections):
+        temp = np.angle(np.sum(np.exp(2j*m.pi*a)*p))/(2*m.pi)
+        if temp < 0:
+            temp += 1
+        circ_mean.append(temp)
+
+    if center is None:
+        center = circ_mean
+    c = np.array(center)-0.5
+
+    avg_pos = []
+    for i, (a, p) in enumerate(zip(grid_points, projections)):
+        avg_pos.append(np.sum(((a-c[i]) % 1 + c[i])*p))
+
+    return circ_mean, np.array(avg_pos) % 1
+
 def get_sg(sym, pos_file, settings):
     """
     Fetches space group and point group
@@ -596,6 +839,91 @@ def get_sg(sym, pos_file, settings):
 
 
 
+class Eigenval:
+    """
+    An EIGENVAL file parsed once into arrays. Supports spin polarized and
+    non spin polarized calculations with any number of k-points.
+
+    Input:
+        eig_file: string that is the path to a EIGENVAL file
+
+    Attributes:
+        ispin: number of spin channels
+        nkpts: number of k-points
+        nbands: number of bands
+        kpoints: k-point coordinates and weights, shape (nkpts, 4)
+        index: band indices, shape (nbands,)
+        energies: eigenvalues, shape (ispin, nkpts, nbands)
+        occupations: occupations, shape (ispin, nkpts, nbands)
+    """
+
+    def __init__(self, eig_file):
+        self.path = eig_file
+        with open(eig_file, "r") as f:
+            lines = f.read().splitlines()
+
+        self.ispin = int(lines[0].split()[3])
+        self.nkpts, self.nbands = [int(x) for x in lines[5].split()[1:3]]
+
+        body = [line for line in lines[6:] if line.strip()]
+        block = self.nbands + 1
+        if len(body) < self.nkpts*block:
+            raise ValueError("EIGENVAL file "+eig_file+" is incomplete")
+
+        self.kpoints = np.array([[float(x) for x in body[k*block].split()[:4]] for k in range(self.nkpts)])
+        rows = " ".join(line for k in range(self.nkpts) for line in body[k*block+1:(k+1)*block]).split()
+        ncol = len(body[1].split())
+        data = np.array(rows, dtype=float).reshape(self.nkpts, self.nbands, ncol)
+
+        self.index = data[0, :, 0].astype(int)
+        self.energies = np.moveaxis(data[:, :, 1:1+self.ispin], 2, 0)
+        if ncol > 1+self.ispin:
+            self.occupations = np.moveaxis(data[:, :, 1+self.ispin:1+2*self.ispin], 2, 0)
+        else:
+            # Older versions of VASP do not write occupations
+            self.occupations = np.zeros_like(self.energies)
+
+    def energy(self, spin, bands, kpoint=1):
+        """
+        Eigenvalues of bands (1-based indices) in spin channel spin (1 or 2).
+        """
+        return self.energies[spin-1, kpoint-1, np.asarray(bands, dtype=int)-1]
+
+    def occupation(self, spin, bands, kpoint=1):
+        """
+        Occupations of bands (1-based indices) in spin channel spin (1 or 2).
+        """
+        return self.occupations[spin-1, kpoint-1, np.asarray(bands, dtype=int)-1]
+
+    def highest_occupied_band(self):
+        """
+        Highest band with non-zero occupation in any spin channel or k-point.
+        """
+        occupied = np.any(np.round(self.occupations, 6) != 0, axis=(0, 1))
+        if not np.any(occupied):
+            return 0
+        return int(self.index[np.nonzero(occupied)[0][-1]])
+
+_eigenvals = {}
+
+def get_eigenval(eig_file):
+    """
+    Returns the Eigenval of eig_file, parsed once per path and
+    modification time. Reuses eig_file if it already is an Eigenval.
+
+    Input:
+        eig_file: string that is the path to a EIGENVAL file, or an Eigenval
+    Returns:
+        Eigenval
+    """
+    if isinstance(eig_file, Eigenval):
+        return eig_file
+    key = os.path.abspath(eig_file)
+    mtime = os.path.getmtime(eig_file)
+    if key not in _eigenvals or _eigenvals[key][0] != mtime:
+        _eigenvals[key] = (mtime, Eigenval(eig_file))
+    return _eigenvals[key][1]
+
 def get_energy_and_band_degen(eig_file, spin_i, bands, settings):
     """
     Extracts band index, eigenvalue and occupation,
@@ -614,23 +942,10 @@ def get_energy_and_band_degen(eig_file, spin_i, bands, settings):
     """
 
     # Get energies from EIGENVAL
-    file = open(eig_file,"r")
-    contents = file.readlines()
-    file.close()
-
-    band_num = []
-    band_en = []
-    band_occ = []
-
-    for i in bands:
-        line = contents[i+7].split()
-        band_num.append(line[0])
-        if spin_i == 1:
-            band_en.append(line[1])
-            band_occ.append(float(line[3]))
-        if spin_i == 2:
-            band_en.append(line[2])
-            band_occ.append(float(line[4]))
+    eig = get_eigenval(eig_file)
+    band_num = eig.index[np.asarray(bands, dtype=int)-1].tolist()
+    band_en = eig.energy(spin_i, bands).tolist()
+    band_occ = eig.occupation(spin_i, bands).tolist()
 
     bands_by_degen = []
     band_en_by_degen = []
@@ -694,21 +1009,22 @@ def group_name_conv(gname):
         str = 'C1h'
     return str
 
-def get_character_table(gname,settings):
+def parse_character_table(path):
     """
-    Get character table as array from gname.lis
+    Parses a character table in the .lis format of the Katzer collection.
 
     Input:
-        gname: name of point group
-        settings: path to settings file
+        path: path to the .lis file
 
     Returns:
         character table
         position vectors and their representation
+        list with True for each reducible representation
     """
-    file = open(settings['char_table_dir']+"/"+gname+".lis","r")
+    file = open(path,"r")
 
     lines = file.readlines()
+    file.close()
     endoftable = lines[1:-1].index(" \n")
     lines = lines[1:endoftable+1]
 
@@ -726,15 +1042,16 @@ def get_character_table(gname,settings):
                 break
 
     char_table = [topline_list]
+    reducible = []
 
     for i in range(1,len(lines)):
         row = lines[i].split()[0:last_col[i-1]]
         try:
             row.remove("*")
             last_col[i-1] = last_col[i-1] - 1
-            print(row[0]+" is reducible.")
+            reducible.append(True)
         except:
-            0
+            reducible.append(False)
         char_table.append(row)
 
     pos_vec_rep = []
@@ -762,8 +1079,171 @@ def get_character_table(gname,settings):
         pos_vec_rep[i][1] = cartesian_comp_str
 
 
+    return char_table, pos_vec_rep, reducible
+
+
+CHAR_TABLE_CACHE = "character_tables.npz"
+
+def compile_character_tables(char_table_dir, cache_path=None):
+    """
+    Parses every .lis file in char_table_dir once and stores all tables in
+    a single .npz file, read by get_character_table() instead of the text
+    files.
+
+    Input:
+        char_table_dir: directory with character tables
+        cache_path: path of the compiled file, default
+                    character_tables.npz in char_table_dir
+    Returns:
+        path of the compiled file
+    """
+    if cache_path is None:
+        cache_path = os.path.join(char_table_dir, CHAR_TABLE_CACHE)
+
+    arrays = {}
+    groups = []
+    for fname in sorted(os.listdir(char_table_dir)):
+        if not fname.endswith(".lis"):
+            continue
+        gname = fname[:-4]
+        try:
+            char_table, pos_vec_rep, reducible = parse_character_table(os.path.join(char_table_dir, fname))
+        except Exception as e:
+            print("Could not compile character table "+fname+": "+str(e))
+            continue
+        groups.append(gname)
+        rows = char_table[1:]
+        arrays[gname+"__header"] = np.array(char_table[0], dtype=str)
+        arrays[gname+"__rows"] = np.array([c for row in rows for c in row], dtype=str)
+        arrays[gname+"__row_lengths"] = np.array([len(row) for row in rows], dtype=int)
+        arrays[gname+"__reducible"] = np.array(reducible, dtype=bool)
+        arrays[gname+"__pos_rows"] = np.array([next(i for i, row in enumerate(rows) if row is p[0]) for p in pos_vec_rep], dtype=int)
+        arrays[gname+"__pos_comps"] = np.array([p[1] for p in pos_vec_rep], dtype=str)
+        arrays[gname+"__mult"] = np.array(get_class_order(char_table)[1], dtype=int)
+        try:
+            arrays[gname+"__characters"] = np.array([[int(c) for c in row[1:]] for row in rows], dtype=int)
+        except ValueError:
+            pass
+    arrays["groups"] = np.array(groups, dtype=str)
+
+    # Unique temporary file, so runs compiling the same directory at the
+    # same time never write to each other's file
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(cache_path)), prefix=CHAR_TABLE_CACHE+".", suffix=".tmp", delete=False) as f:
+        tmp = f.name
+        try:
+            np.savez(f, **arrays)
+        except BaseException:
+            f.close()
+            os.remove(tmp)
+            raise
+    os.replace(tmp, cache_path)
+    return cache_path
+
+_char_table_files = {}
+_char_tables = {}
+
+def load_character_table_cache(char_table_dir):
+    """
+    Returns the compiled character tables of char_table_dir, compiling them
+    first if the compiled file is missing or older than any .lis file.
+    Opened once per directory, the tables themselves are read lazily.
+    A corrupt compiled file is compiled again. None if the tables can not
+    be compiled, e.g. in a read-only directory.
+    """
+    if char_table_dir not in _char_table_files:
+        cache_path = os.path.join(char_table_dir, CHAR_TABLE_CACHE)
+        try:
+            newest = max([os.path.getmtime(os.path.join(char_table_dir, f)) for f in os.listdir(char_table_dir) if f.endswith(".lis")], default=0)
+            if not os.path.exists(cache_path) or os.path.getmtime(cache_path) < newest:
+                compile_character_tables(char_table_dir, cache_path)
+            try:
+                data = np.load(cache_path)
+                groups = set(data["groups"].tolist())
+            except (ValueError, KeyError, EOFError, zipfile.BadZipFile) as e:
+                print("Compiled character tables "+cache_path+" are corrupt ("+str(e)+"), compiling them again")
+                compile_character_tables(char_table_dir, cache_path)
+                data = np.load(cache_path)
+                groups = set(data["groups"].tolist())
+            _char_table_files[char_table_dir] = (data, groups)
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            _char_table_files[char_table_dir] = None
+    return _char_table_files[char_table_dir]
+
+def get_character_table(gname,settings):
+    """
+    Get character table as array from gname.lis, through the compiled
+    tables of char_table_dir. Each table is read once, every call returns
+    a new copy that can be modified freely.
+
+    Input:
+        gname: name of point group
+        settings: path to settings file
+
+    Returns:
+        character table
+        position vectors and their representation
+    """
+    char_table_dir = settings['char_table_dir']
+    key = (char_table_dir, gname)
+    if key not in _char_tables:
+        compiled = load_character_table_cache(char_table_dir)
+        char_table = None
+        if compiled is not None and gname in compiled[1]:
+            data = compiled[0]
+            try:
+                header = data[gname+"__header"].tolist()
+                cells = data[gname+"__rows"].tolist()
+                bounds = np.cumsum(np.concatenate([[0], data[gname+"__row_lengths"]]))
+                rows = [cells[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+                reducible = data[gname+"__reducible"].tolist()
+                pos_vec_rep = [[rows[i], comp] for i, comp in zip(data[gname+"__pos_rows"].tolist(), data[gname+"__pos_comps"].tolist())]
+                char_table = [header] + rows
+            except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile) as e:
+                print("Could not read "+gname+" from the compiled character tables ("+str(e)+"), reading "+gname+".lis")
+        if char_table is None:
+            char_table, pos_vec_rep, reducible = parse_character_table(os.path.join(char_table_dir, gname+".lis"))
+        for row, red in zip(char_table[1:], reducible):
+            if red:
+                print(row[0]+" is reducible.")
+        _char_tables[key] = (char_table, pos_vec_rep)
+
+    char_table, pos_vec_rep = copy.deepcopy(_char_tables[key])
     return char_table, pos_vec_rep
 
+_char_arrays = {}
+
+def get_character_arrays(gname, settings):
+    """
+    Characters and class multiplicities of gname as integer arrays, taken
+    from the compiled tables so the text rows are not parsed again.
+
+    Input:
+        gname: name of point group
+        settings: settings dicitonary
+
+    Returns:
+        characters of the irreps, shape (n_irreps, n_classes)
+        multiplicity (order) of each class
+    """
+    char_table_dir = settings['char_table_dir']
+    key = (char_table_dir, gname)
+    if key not in _char_arrays:
+        arrays = None
+        compiled = load_character_table_cache(char_table_dir)
+        if compiled is not None and gname+"__characters" in compiled[0].files:
+            try:
+                arrays = (compiled[0][gname+"__characters"].astype(int), compiled[0][gname+"__mult"].astype(int))
+            except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+                pass
+        if arrays is None:
+            char_table = get_character_table(gname, settings)[0]
+            characters = np.array([[int(c) for c in row[1:]] for row in char_table[1:]], dtype=int).reshape(len(char_table)-1, -1)
+            arrays = (characters, np.array(get_class_order(char_table)[1], dtype=int))
+        _char_arrays[key] = arrays
+
+    characters, mult = _char_arrays[key]
+    return characters.copy(), mult.copy()
+
 
 def get_vb_and_cb(eig_file, lower_b, upper_b, spin_channel):
     """
@@ -780,17 +1260,15 @@ def get_vb_and_cb(eig_file, lower_b, upper_b, spin_channel):
         conduction band eigenvalue
     """
 
-    f = open(eig_file, "r")
-    lines = f.readlines()
-    f.close()
+    eig = get_eigenval(eig_file)
 
     if type(lower_b) == type([]):
         lower_b = lower_b[0]
-    vb = lines[lower_b+6].split()[spin_channel]
+    vb = eig.energy(spin_channel, lower_b-1)
 
     if type(upper_b) == type([]):
         upper_b = upper_b[-1]
-    cb = lines[upper_b+8].split()[spin_channel]
+    cb = eig.energy(spin_channel, upper_b+1)
 
     return float(vb), float(cb)
 
@@ -936,35 +1414,144 @@ def gvectors_and_energy(wav, ikpt=1, force_Gamma=False, check_consistency=False)
 
     return np.asarray(Gvec, dtype=int), KENERGY
 
+class WavecarSession:
+    """
+    A WAVECAR opened once per run. The header is parsed once, the band
+    records are memory-mapped and the g-vectors, their kinetic energies and
+    the symmetry tables of the overlaps (see overlap.get_gvector_setup())
+    are cached, so the session can be passed through every stage of the
+    analysis instead of the file path. Other attributes (_encut, _ngrid, ...)
+    are those of the underlying vaspwfc object.
+
+    Input:
+        wf_file: string that is the path to a WAVECAR file
+        lgamma: True if the WAVECAR is from a Gamma-point only calculation
+    """
+
+    def __init__(self, wf_file, lgamma=True):
+        self.path = wf_file
+        self.lgamma = lgamma
+        self.wav = vaspwfc(wf_file, lgamma=lgamma)
+        self._mmap = np.memmap(wf_file, dtype=np.uint8, mode='r')
+        self._gvectors = {}
+        self._gvectors_and_energy = {}
+        self._symmetry_tables = {}
+
+    def __getattr__(self, name):
+        if name == "wav":
+            raise AttributeError(name)
+        return getattr(self.wav, name)
+
+    def gvectors(self, ikpt=1, force_Gamma=False):
+        """
+        Cached g-vectors of k-point ikpt, as vaspwfc.gvectors().
+        """
+        key = (ikpt, force_Gamma)
+        if key not in self._gvectors:
+            self._gvectors[key] = self.wav.gvectors(ikpt=ikpt, force_Gamma=force_Gamma)
+        return self._gvectors[key]
+
+    def gvectors_and_energy(self, ikpt=1, force_Gamma=False):
+        """
+        Cached g-vectors and kinetic energies of k-point ikpt, as gvectors_and_energy().
+        """
+        key = (ikpt, force_Gamma)
+        if key not in self._gvectors_and_energy:
+            self._gvectors_and_energy[key] = gvectors_and_energy(self.wav, ikpt=ikpt, force_Gamma=force_Gamma)
+        return self._gvectors_and_energy[key]
+
+    def band_record(self, ispin=1, ikpt=1, iband=1):
+        """
+        Zero-copy view of the plane wave coefficients of a band in the WAVECAR.
+
+        Input:
+            ispin: spin channel
+            ikpt: k-point index
+            iband: band index
+        Returns:
+            read-only array of coefficients, in the precision of the file
+        """
+        self.wav.checkIndex(ispin, ikpt, iband)
+        rec = self.wav.whereRec(ispin, ikpt, iband)
+        nplw = self.wav._nplws[ikpt - 1]
+        return np.frombuffer(self._mmap, dtype=self.wav._WFPrec, count=nplw, offset=rec * self.wav._recl)
+
+    def read_band(self, ispin=1, ikpt=1, iband=1, index=None, dtype=np.complex128):
+        """
+        Reads the plane wave coefficients of a band straight from the
+        memory-mapped record, gathering only the chosen g-vectors so that
+        only the pages holding them are read.
+
+        Input:
+            ispin: spin channel
+            ikpt: k-point index
+            iband: band index
+            index: indices of the g-vectors to read, default all
+            dtype: complex type of the returned coefficients
+        Returns:
+            array of (unnormalized) coefficients
+        """
+        cg = self.band_record(ispin, ikpt, iband)
+        if index is not None:
+            cg = cg[index]
+        return np.asarray(cg, dtype=dtype)
+
+    def readBandCoeff(self, ispin=1, ikpt=1, iband=1, norm=False):
+        """
+        Reads the plane wave coefficients of a band, as vaspwfc.readBandCoeff().
+        """
+        cg = np.asarray(self.band_record(ispin, ikpt, iband), dtype=np.complex128)
+        if norm:
+            cg /= np.linalg.norm(cg)
+        return cg
+
+    def wfc_r(self, ispin=1, ikpt=1, iband=1, gvec=None, Cg=None, ngrid=None, **kwargs):
+        """
+        Realspace wavefunction of a band, as vaspwfc.wfc_r(), with
+        coefficients and g-vectors taken from the session.
+        """
+        if Cg is None:
+            Cg = self.readBandCoeff(ispin, ikpt, iband)
+        if gvec is None:
+            gvec = self.gvectors(ikpt=ikpt)
+        return self.wav.wfc_r(ispin, ikpt, iband, gvec=gvec, Cg=Cg, ngrid=ngrid, **kwargs)
+
+def open_wavecar(wf_file, lgamma=True):
+    """
+    Returns a WavecarSession, reusing wf_file if it already is one.
+    A session opened with another lgamma is reopened with the requested one.
+
+    Input:
+        wf_file: string that is the path to a WAVECAR file, or a WavecarSession
+        lgamma: True if the WAVECAR is from a Gamma-point only calculation
+    Returns:
+        WavecarSession
+    """
+    if isinstance(wf_file, WavecarSession):
+        if wf_file.lgamma == lgamma:
+            return wf_file
+        print("WAVECAR session was opened with lgamma="+str(wf_file.lgamma)+", reopening with lgamma="+str(lgamma))
+        wf_file = wf_file.path
+    return WavecarSession(wf_file, lgamma=lgamma)
+
 def find_HOB(eig_file="EIGENVAL"):
     """
     Finds highest occupied band via eigenvalue file.
     """
-    f=open(eig_file,"r")
-    lines=f.readlines()[8:]
-    f.close()
-    hob1=0
-    hob2=0
-    for line in lines:
-        line = line.split()
-        if line[3] != "0.000000":
-            hob1 = int(line[0])
-        if line[4] != "0.000000":
-            hob2 = int(line[0])
-    return max(hob1, hob2)
+    return get_eigenval(eig_file).highest_occupied_band()
 
 def calc_ipr(wf_file, spin_channel, HOB, grid_mult=1, extent = 15):
     """
     Calculates inverse participation ratio for 30 (default) bands around the highest
     occupied band.
     Inputs:
-        wf_file: string that is the path to a WAVECAR file
+        wf_file: string that is the path to a WAVECAR file, or a WavecarSession
         spin_channel: 1 or 2 for spin up or down
         HOB: highest occupied band (integer)
         grid_mult: makes realspace grid denser
         extent: how many bands above and below the HOB are considered
     """
-    wav = vaspwfc(wf_file, lgamma=True)
+    wav = open_wavecar(wf_file, lgamma=True)
 
     # Grid density can be increased but this makes this script slower
     grid = wav._ngrid.copy() * grid_mult
@@ -989,7 +1576,7 @@ def find_vb_and_cb(eig_file, wf_file):
     Assumes that no orbitals are excited from or to delocalized states.
     Inputs:
         eig_file: string that is the path to a EIGENVAL file
-        wf_file: string that is the path to a WAVECAR file
+        wf_file: string that is the path to a WAVECAR file, or a WavecarSession
     returns:
         eigenvalues of VBM and CBm
         iprs in an array
@@ -998,19 +1585,19 @@ def find_vb_and_cb(eig_file, wf_file):
     iprs = calc_ipr(wf_file, 1, HOB)
     ipr_avg = np.average(iprs)
 
-    f=open(eig_file,"r")
-    lines=f.readlines()[7-15+HOB:HOB+15+7]
-    f.close()
+    eig = get_eigenval(eig_file)
+    bands = np.arange(HOB-15, HOB+15)
+    energies = eig.energy(1, bands)
+    occupations = np.round(eig.occupation(1, bands), 6)
     vb = 0
     cb = 0
 
     for n, ipr in enumerate(iprs):
-        line = lines[n].split()
-        if ipr < 0.0001 and line[3] == "1.000000":
-            vb = float(line[1])
+        if ipr < 0.0001 and occupations[n] == 1:
+            vb = float(energies[n])
 
-        if ipr < 0.0001 and line[3] == "0.000000" and cb == 0:
-            cb = float(line[1])
+        if ipr < 0.0001 and occupations[n] == 0 and cb == 0:
+            cb = float(energies[n])
 
     return vb, cb, iprs
 
@@ -1094,10 +1681,38 @@ def load_settings(file):
         data['percent_cutoff']
     except Exception as e:
         data['percent_cutoff'] = 0.40
+    try:
+        data['center_method']
+    except Exception as e:
+        data['center_method'] = "realspace"
+    try:
+        data['single_precision_coeffs']
+    except Exception as e:
+        data['single_precision_coeffs'] = False
+    try:
+        data['adaptive_Gvec_tolerance']
+    except Exception as e:
+        data['adaptive_Gvec_tolerance'] = 0
     try:
         data['char_table_dir']
     except Exception as e:
         data['char_table_dir'] = "/path/to/character_tables"
+    try:
+        data['snap_centers']
+    except Exception as e:
+        data['snap_centers'] = False
+    try:
+        data['center_replacement']
+    except Exception as e:
+        data['center_replacement'] = "sequential"
+    try:
+        data['overlaps_json']
+    except Exception as e:
+        data['overlaps_json'] = False
+    try:
+        data['cache_dir']
+    except Exception as e:
+        data['cache_dir'] = ""
     return data
 
 
@@ -7,10 +7,443 @@ import math as m
 from extract import *
 from pprint import pprint
 import os
+import copy
 import json
 import ast
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
 
-def calc_overlap(Coeff, gvec, Sym_op, center, settings):
+class GvecIndex:
+    """
+    Lookup table from integer g-vectors to their index in a list of g-vectors.
+
+    The g-vectors are placed on a dense integer grid spanning their bounding
+    box, so finding the index of any (rotated) g-vector is a single array
+    access instead of a scan over the whole list. Built once per output of
+    gvectors_and_energy() and reused for every band and symmetry operator.
+
+    Input:
+        gvec: list of g-vectors (integer coordinates)
+    """
+
+    def __init__(self, gvec):
+        gvec = np.rint(np.asarray(gvec)).astype(int)
+        self.gvec = gvec
+        self.offset = gvec.min(axis=0)
+        self.shape = tuple(gvec.max(axis=0) - self.offset + 1)
+        self.grid = np.full(self.shape, -1, dtype=np.intp)
+        shifted = gvec - self.offset
+        self.grid[shifted[:,0], shifted[:,1], shifted[:,2]] = np.arange(len(gvec))
+
+    def find(self, G):
+        """
+        Finds the index of one or several g-vectors.
+
+        Input:
+            G: g-vector or array of g-vectors, rounded to integers
+        Returns:
+            index of each g-vector, -1 where it is not in the list
+        """
+        G = np.rint(np.asarray(G)).astype(int)
+        single = G.ndim == 1
+        G = np.atleast_2d(G) - self.offset
+        inside = np.all((G >= 0) & (G < np.array(self.shape)), axis=1)
+        index = np.full(len(G), -1, dtype=np.intp)
+        g = G[inside]
+        index[inside] = self.grid[g[:,0], g[:,1], g[:,2]]
+        if single:
+            return index[0]
+        return index
+
+def gamma_half_mirror(G):
+    """
+    Checks which g-vectors lie outside the half sphere stored in a
+    Gamma-point WAVECAR, those are found as the conjugate of -G.
+
+    Input:
+        G: array of g-vectors
+    Returns:
+        boolean array, True where -G is stored instead of G
+    """
+    G = np.atleast_2d(G)
+    return (G[:,0] < 0) | ((G[:,0] == 0) & ((G[:,1] < 0) | ((G[:,1] == 0) & (G[:,2] < 0))))
+
+def find_rotated_partners(gvec, sym_op_inv, gindex):
+    """
+    Finds the index of the rotated partner G*S^-1 of each g-vector. Partners
+    outside the stored half sphere are found as -G*S^-1 instead.
+
+    Input:
+        gvec: list of g-vectors
+        sym_op_inv: inverse of symmetry operator matrix
+        gindex: GvecIndex of gvec
+    Returns:
+        index of the partner of each g-vector
+        boolean array, True where the partner coefficient is conjugated
+    """
+    G_R = np.rint(np.asarray(gvec).dot(sym_op_inv)).astype(int)
+    mirror = gamma_half_mirror(G_R)
+    G_R[mirror] *= -1
+    j = gindex.find(G_R)
+    if np.any(j < 0):
+        raise ValueError("Rotated g-vector not found, the g-vector set is not closed under the symmetry operator.")
+    return j, ~mirror
+
+class SymmetryGTable:
+    """
+    Permutation and conjugation tables of the g-vectors for every symmetry
+    operator. These only depend on the operators and the g-vectors, so the
+    table is computed once and shared by all bands, leaving a gather and a
+    dot product per band and operator.
+
+    Input:
+        Sym_ops: array with symmetry operator info,
+                 output for get_symmetry_operators()
+        gvec: list of g-vectors
+        gindex: GvecIndex of gvec, built here if not given
+    """
+
+    def __init__(self, Sym_ops, gvec, gindex=None):
+        if gindex is None:
+            gindex = GvecIndex(gvec)
+        self.gvec = np.asarray(gvec)
+        self.sym_ops_inv = np.array([np.linalg.inv(S) for S in Sym_ops[1]])
+
+        n_ops = len(self.sym_ops_inv)
+        self.index = np.empty((n_ops, len(self.gvec)), dtype=np.intp)
+        self.conj = np.empty((n_ops, len(self.gvec)), dtype=bool)
+        for k, S_inv in enumerate(self.sym_ops_inv):
+            self.index[k], self.conj[k] = find_rotated_partners(self.gvec, S_inv, gindex)
+
+    def phases(self, center, ops=slice(None)):
+        """
+        Phase factors exp(2*pi*i G.(r - S^-1 r)) of the chosen operators.
+
+        Input:
+            center: center of orbital, fixed point
+            ops: index or slice of symmetry operators
+        Returns:
+            array of phase factors, shape (n_ops, n_gvec)
+        """
+        return calc_phases(self.gvec, self.sym_ops_inv[ops], center)
+
+    def overlap(self, Coeff, k, center):
+        """
+        Calculates the SOEV of one band for symmetry operator k.
+
+        Input:
+            Coeff: list of plane wave coefficients
+            k: index of the symmetry operator
+            center: center of orbital, fixed point
+        Returns:
+            overlap or SOEV
+        """
+        return self.overlaps(Coeff, center, ops=[k])[0]
+
+    def overlaps(self, Coeff, center, ops=None, chunk_size=8):
+        """
+        Calculates the SOEVs of one band for all (or the chosen) operators.
+        Phase factors are only built for chunk_size operators at a time.
+
+        Input:
+            Coeff: list of plane wave coefficients
+            center: center of orbital, fixed point
+            ops: list of operator indices, default all operators
+            chunk_size: number of operators handled at once
+        Returns:
+            array with overlap for each operator
+        """
+        if ops is None:
+            ops = np.arange(len(self.sym_ops_inv))
+        ops = np.asarray(ops)
+        overlaps = np.empty(len(ops), dtype=complex)
+        for a in range(0, len(ops), chunk_size):
+            chunk = ops[a:a+chunk_size]
+            overlaps[a:a+chunk_size] = soev_kernel(Coeff, self.index[chunk], self.conj[chunk],
+                                                   self.phases(center, chunk), chunk_size)
+        return overlaps
+
+    def prefix_overlaps(self, Coeff, center, prefix_lengths, ops=None, chunk_size=8):
+        """
+        Calculates the SOEVs of one band using only the first n g-vectors,
+        for several n at once. With g-vectors sorted by kinetic energy each
+        n corresponds to a lower cutoff energy.
+
+        Input:
+            Coeff: list of plane wave coefficients
+            center: center of orbital, fixed point
+            prefix_lengths: list of numbers of g-vectors to include
+            ops: list of operator indices, default all operators
+            chunk_size: number of operators handled at once
+        Returns:
+            array with overlaps, shape (n_ops, n_prefixes)
+        """
+        if ops is None:
+            ops = np.arange(len(self.sym_ops_inv))
+        ops = np.asarray(ops)
+        overlaps = np.empty((len(ops), len(prefix_lengths)), dtype=complex)
+        for a in range(0, len(ops), chunk_size):
+            chunk = ops[a:a+chunk_size]
+            overlaps[a:a+chunk_size] = soev_prefix_kernel(Coeff, self.index[chunk], self.conj[chunk],
+                                                          self.phases(center, chunk), prefix_lengths, chunk_size)
+        return overlaps
+
+    def segment_overlaps(self, Coeff, center, start, stop, chunk_size=8):
+        """
+        Contribution of the g-vectors start to stop to the SOEVs of one band,
+        for all operators.
+
+        Input:
+            Coeff: list of plane wave coefficients
+            center: center of orbital, fixed point
+            start: index of first g-vector
+            stop: index after the last g-vector
+            chunk_size: number of operators handled at once
+        Returns:
+            array with partial overlap for each operator
+        """
+        seg = slice(start, stop)
+        n_ops = len(self.sym_ops_inv)
+        overlaps = np.empty(n_ops, dtype=complex)
+        for a in range(0, n_ops, chunk_size):
+            b = a + chunk_size
+            C_p = Coeff[self.index[a:b, seg]]
+            np.conjugate(C_p, out=C_p, where=self.conj[a:b, seg])
+            C_p *= calc_phases(self.gvec[seg], self.sym_ops_inv[a:b], center)
+            overlaps[a:b] = C_p.dot(Coeff[seg])
+        return overlaps
+
+    def overlap_matrix(self, Coeffs, centers, ops=None, chunk_size=8):
+        """
+        Calculates the SOEVs of several bands for all (or the chosen) operators.
+
+        Input:
+            Coeffs: plane wave coefficients of each band, shape (n_bands, n_gvec)
+            centers: center of each band
+            ops: list of operator indices, default all operators
+            chunk_size: number of operators handled at once
+        Returns:
+            array with overlaps, shape (n_bands, n_ops)
+        """
+        if ops is None:
+            ops = np.arange(len(self.sym_ops_inv))
+        ops = np.asarray(ops)
+        Coeffs = np.atleast_2d(Coeffs)
+        centers = np.atleast_2d(centers)
+        overlaps = np.empty((len(Coeffs), len(ops)), dtype=complex)
+        for a in range(0, len(ops), chunk_size):
+            chunk = ops[a:a+chunk_size]
+            C_p = Coeffs[:, self.index[chunk]]
+            np.conjugate(C_p, out=C_p, where=self.conj[chunk])
+            C_p *= np.array([self.phases(c, chunk) for c in centers])
+            overlaps[:, a:a+chunk_size] = np.einsum('bkg,bg->bk', C_p, Coeffs)
+        return overlaps
+
+    def candidate_overlaps(self, Coeffs, candidates, ops=None, chunk_size=8):
+        """
+        Calculates the SOEVs of several bands for each of several candidate
+        centers. The gathered coefficient products do not depend on the
+        center, so they are built once and only the phases change.
+
+        Input:
+            Coeffs: plane wave coefficients of each band, shape (n_bands, n_gvec)
+            candidates: list of candidate centers
+            ops: list of operator indices, default all operators
+            chunk_size: number of operators handled at once
+        Returns:
+            array with overlaps, shape (n_candidates, n_bands, n_ops)
+        """
+        if ops is None:
+            ops = np.arange(len(self.sym_ops_inv))
+        ops = np.asarray(ops)
+        Coeffs = np.atleast_2d(Coeffs)
+        candidates = np.atleast_2d(candidates)
+        overlaps = np.empty((len(candidates), len(Coeffs), len(ops)), dtype=complex)
+        for a in range(0, len(ops), chunk_size):
+            chunk = ops[a:a+chunk_size]
+            C_p = Coeffs[:, self.index[chunk]]
+            np.conjugate(C_p, out=C_p, where=self.conj[chunk])
+            C_p *= Coeffs[:, None, :]
+            for c, center in enumerate(candidates):
+                overlaps[c, :, a:a+chunk_size] = np.einsum('bkg,kg->bk', C_p, self.phases(center, chunk))
+        return overlaps
+
+    def rep_matrices(self, Coeffs, center, ops=None, chunk_size=8):
+        """
+        Calculates the matrix elements <psi_j|U|psi_i> between the bands of a
+        degenerate level, normalized so that the diagonal holds the SOEVs.
+
+        Input:
+            Coeffs: plane wave coefficients of each band, shape (n_bands, n_gvec)
+            center: center of the degenerate orbitals, fixed point
+            ops: list of operator indices, default all operators
+            chunk_size: number of operators handled at once
+        Returns:
+            representation matrices, shape (n_ops, n_bands, n_bands)
+        """
+        if ops is None:
+            ops = np.arange(len(self.sym_ops_inv))
+        ops = np.asarray(ops)
+        Coeffs = np.atleast_2d(Coeffs)
+        norm = np.sqrt(np.real(np.sum(Coeffs*Coeffs.conj(), axis=1)))
+        matrices = np.empty((len(ops), len(Coeffs), len(Coeffs)), dtype=complex)
+        for a in range(0, len(ops), chunk_size):
+            chunk = ops[a:a+chunk_size]
+            C_p = Coeffs[:, self.index[chunk]]
+            np.conjugate(C_p, out=C_p, where=self.conj[chunk])
+            C_p *= self.phases(center, chunk)
+            matrices[a:a+chunk_size] = np.einsum('jkg,ig->kij', C_p, Coeffs)
+        return matrices / np.outer(norm, norm)
+
+def soev_kernel(Coeff, index, conj, phases, chunk_size=8):
+    """
+    Calculates the SOEVs of one band for a stack of symmetry operators.
+
+    Input:
+        Coeff: list of plane wave coefficients
+        index: partner index of each g-vector, shape (n_ops, n_gvec)
+        conj: True where the partner is conjugated, shape (n_ops, n_gvec)
+        phases: phase factor of each g-vector, shape (n_ops, n_gvec)
+        chunk_size: number of operators handled at once
+    Returns:
+        array with overlap for each operator
+    """
+    overlaps = np.empty(len(index), dtype=complex)
+    for a in range(0, len(index), chunk_size):
+        b = a + chunk_size
+        C_p = Coeff[index[a:b]]
+        np.conjugate(C_p, out=C_p, where=conj[a:b])
+        C_p *= phases[a:b]
+        overlaps[a:b] = C_p.dot(Coeff)
+    return overlaps
+
+def soev_prefix_kernel(Coeff, index, conj, phases, prefix_lengths, chunk_size=8):
+    """
+    Calculates the SOEVs of one band for a stack of symmetry operators,
+    summing over the first n g-vectors for each n in prefix_lengths.
+    All sums come from one cumulative sum over the g-vectors.
+
+    Input:
+        Coeff: list of plane wave coefficients
+        index: partner index of each g-vector, shape (n_ops, n_gvec)
+        conj: True where the partner is conjugated, shape (n_ops, n_gvec)
+        phases: phase factor of each g-vector, shape (n_ops, n_gvec)
+        prefix_lengths: list of numbers of g-vectors to include
+        chunk_size: number of operators handled at once
+    Returns:
+        array with overlaps, shape (n_ops, n_prefixes)
+    """
+    prefix_lengths = np.asarray(prefix_lengths, dtype=int)
+    overlaps = np.zeros((len(index), len(prefix_lengths)), dtype=complex)
+    nonempty = prefix_lengths > 0
+    for a in range(0, len(index), chunk_size):
+        b = a + chunk_size
+        C_p = Coeff[index[a:b]]
+        np.conjugate(C_p, out=C_p, where=conj[a:b])
+        C_p *= phases[a:b]
+        C_p *= Coeff
+        cumulative = np.cumsum(C_p, axis=1)
+        overlaps[a:b, nonempty] = cumulative[:, prefix_lengths[nonempty]-1]
+    return overlaps
+
+def calc_phases(gvec, sym_ops_inv, center):
+    """
+    Phase factors exp(2*pi*i G.(r - S^-1 r)) of a stack of operators.
+
+    Input:
+        gvec: list of g-vectors
+        sym_ops_inv: inverse symmetry operator matrices, shape (n_ops, 3, 3)
+        center: center of orbital, fixed point
+    Returns:
+        array of phase factors, shape (n_ops, n_gvec)
+    """
+    r_diff = center - sym_ops_inv.dot(center)
+    return np.exp(2j*m.pi*r_diff.dot(gvec.T))
+
+def share_array(arr, blocks):
+    """
+    Copies an array into a new shared memory block.
+
+    Input:
+        arr: numpy array
+        blocks: list where the SharedMemory object is appended
+    Returns:
+        (name, shape, dtype) needed to attach to the array
+    """
+    arr = np.ascontiguousarray(arr)
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    blocks.append(shm)
+    return shm.name, arr.shape, arr.dtype.str
+
+def attach_array(spec):
+    """
+    Attaches to an array shared by share_array().
+
+    Input:
+        spec: (name, shape, dtype) of the shared array
+    Returns:
+        SharedMemory object, to be closed when done
+        numpy array backed by the shared memory
+    """
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def _soev_worker(specs, sym_ops_inv, row, ops, center):
+    """
+    Work unit of parallel_overlap_matrix(): SOEVs of one band for a chunk
+    of operators, with coefficients and tables read from shared memory.
+    """
+    shms, arrays = zip(*[attach_array(spec) for spec in specs])
+    Coeffs, index, conj, gvec = arrays
+    phases = calc_phases(gvec, sym_ops_inv[ops], center)
+    values = soev_kernel(Coeffs[row], index[ops], conj[ops], phases, len(ops))
+    del arrays, Coeffs, index, conj, gvec
+    for shm in shms:
+        shm.close()
+    return row, ops, values
+
+def parallel_overlap_matrix(table, Coeffs, centers, workers, chunk_size=8):
+    """
+    Same as SymmetryGTable.overlap_matrix() but spreads (band, operator chunk)
+    work units over a process pool. Coefficients and tables are passed
+    through shared memory, results are placed by index so the output is
+    ordered exactly as in the serial calculation.
+
+    Input:
+        table: SymmetryGTable
+        Coeffs: plane wave coefficients of each band, shape (n_bands, n_gvec)
+        centers: center of each band
+        workers: number of processes
+        chunk_size: number of operators in each work unit
+    Returns:
+        array with overlaps, shape (n_bands, n_ops)
+    """
+    Coeffs = np.atleast_2d(Coeffs)
+    centers = np.atleast_2d(centers)
+    n_ops = len(table.sym_ops_inv)
+    overlaps = np.empty((len(Coeffs), n_ops), dtype=complex)
+
+    # No file is being written by the writer thread when the pool forks
+    flush_writes()
+
+    blocks = []
+    try:
+        specs = [share_array(arr, blocks) for arr in (Coeffs, table.index, table.conj, table.gvec)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_soev_worker, specs, table.sym_ops_inv, row, np.arange(a, min(a+chunk_size, n_ops)), centers[row])
+                       for row in range(len(Coeffs)) for a in range(0, n_ops, chunk_size)]
+            for future in futures:
+                row, ops, values = future.result()
+                overlaps[row, ops] = values
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+    return overlaps
+
+def calc_overlap(Coeff, gvec, Sym_op, center, settings, gindex=None):
     """
     Calculate overlap of a wavefunction and its symmetry
     transformed counterpart or Symmetry Operator Exppectation Value (SOEV).
@@ -21,36 +454,70 @@ def calc_overlap(Coeff, gvec, Sym_op, center, settings):
         Sym_op: Symmetry operator matrix
         center: center of orbital, fixed point
         settings: settings dicitonary
+        gindex: GvecIndex of gvec, built here if not given
 
     Returns:
         overlap or SOEV
     """
-    C = []
-    C_p = []
+    if gindex is None:
+        gindex = GvecIndex(gvec)
+
     sym_op_inv = np.linalg.inv(Sym_op)
     r_diff = center - sym_op_inv.dot(center)
-    for i, G in enumerate(gvec):
-        G_R = G.dot(sym_op_inv)
-
-        #beta = G.dot(center - sym_op_inv.dot(center))
-        #beta = G.dot(r_diff)
-        #pre_factor = m.e**(2j*m.pi*beta)
-        #C.append(pre_factor*Coeff[i])
-        C.append(m.e**(2j*m.pi*G.dot(r_diff))*Coeff[i])
-
-        if G_R[0] > 0:
-            j = np.where(np.all(gvec == G_R, axis=1))[0][0]
-            C_p.append(Coeff[j].conj())
-        elif G_R[0] < 0 or G_R[1] < 0 or (G_R[1] == 0 and G_R[2] < 0):
-            j = np.where(np.all(gvec == -G_R, axis=1))[0][0]
-            C_p.append(Coeff[j])
+
+    C = np.exp(2j*m.pi*gvec.dot(r_diff))*Coeff
+
+    # Rotated partner of each G, taken as the conjugate of -G_R
+    # when G_R is outside the stored half sphere
+    j, conj = find_rotated_partners(gvec, sym_op_inv, gindex)
+    C_p = np.where(conj, Coeff[j].conj(), Coeff[j])
+
+    return C.dot(C_p)
+
+def adaptive_overlaps(table, Coeff, center, kenergy, tol, n_shells=50, n_converged=3):
+    """
+    Accumulates the overlaps shell by shell in kinetic energy and stops
+    adding shells once no normalized overlap has changed by more than tol
+    for n_converged shells in a row.
+
+    Inputs:
+        table: SymmetryGTable of energy sorted g-vectors
+        Coeff: list of plane wave coefficients, energy sorted
+        center: center of orbital, fixed point
+        kenergy: sorted kinetic energy of each g-vector
+        tol: convergence tolerance of the normalized overlaps
+        n_shells: number of energy shells the g-vectors are divided into
+        n_converged: number of converged shells needed to stop
+
+    Returns:
+        array with (unnormalized) overlap for each operator
+        number of g-vectors used
+    """
+    bounds = np.searchsorted(kenergy, np.linspace(0, kenergy[-1], n_shells+1)[1:], side='right')
+    bounds[-1] = len(kenergy)
+
+    total = np.zeros(len(table.sym_ops_inv), dtype=complex)
+    previous = None
+    converged = 0
+    start = 0
+    for stop in bounds:
+        if stop == start:
+            continue
+        total += table.segment_overlaps(Coeff, center, start, stop)
+        start = stop
+
+        current = total / total[0]
+        if previous is not None and np.max(np.abs(current - previous)) < tol:
+            converged += 1
         else:
-            j = np.where(np.all(gvec == G_R, axis=1))[0][0]
-            C_p.append(Coeff[j].conj())
+            converged = 0
+        previous = current
+        if converged >= n_converged:
+            break
 
-    return np.array(C).dot(np.array(C_p))
+    return total, start
 
-def get_overlap_list(Coeff, gvec, Sym_ops, center, settings):
+def get_overlap_list(Coeff, gvec, Sym_ops, center, settings, table=None, kenergy=None, gvec_counts=None):
     """
     Calculate overlap for all symmetry operations for one band/orbital.
 
@@ -61,19 +528,38 @@ def get_overlap_list(Coeff, gvec, Sym_ops, center, settings):
                  output for get_symmetry_operators()
         center: center of orbital, fixed point
         settings: settings dicitonary
+        table: SymmetryGTable of Sym_ops and gvec, built here if not given
+        kenergy: sorted kinetic energy of each g-vector, needed for the
+                 adaptive cutoff (adaptive_Gvec_tolerance > 0)
+        gvec_counts: list the number of g-vectors used by the adaptive
+                     cutoff is appended to, printed if not given
 
     Returns:
         list of containing:
         index, symbol, axis, angle and overlap for each operator
     """
-    # Identity operator is trivial
-    symmetry_info = [[0,Sym_ops[0][0], Sym_ops[2][0], Sym_ops[3][0]]]
-    ov_list = [np.real_if_close(np.sum(Coeff*Coeff.conj())).tolist()]
+    if table is None:
+        table = SymmetryGTable(Sym_ops, gvec)
+
+    adaptive_tol = settings['adaptive_Gvec_tolerance']
+
+    if adaptive_tol > 0 and kenergy is not None:
+        overlaps, n_used = adaptive_overlaps(table, Coeff, center, kenergy, adaptive_tol)
+        if gvec_counts is None:
+            print("Adaptive cutoff used "+str(n_used)+" of "+str(len(kenergy))+" g-vectors")
+        else:
+            gvec_counts.append(n_used)
+        ov_list = [np.real_if_close(np.real(overlaps[0])).tolist()]
+        overlaps = overlaps[1:]
+    else:
+        # Identity operator is trivial
+        ov_list = [np.real_if_close(np.sum(Coeff*Coeff.conj())).tolist()]
 
-    # Loop over each symmetry operator
-    for i, S in enumerate(Sym_ops[1][1:]):
+        # All other operators in one batch
+        overlaps = table.overlaps(Coeff, center, ops=range(1, len(Sym_ops[1])))
 
-        overlap = calc_overlap(Coeff, gvec, S, center, settings)
+    symmetry_info = [[0,Sym_ops[0][0], Sym_ops[2][0], Sym_ops[3][0]]]
+    for i, overlap in enumerate(overlaps):
         i +=1
         ov_list.append(np.real_if_close(overlap).tolist())
         symmetry_info.append([i, Sym_ops[0][i], Sym_ops[2][i], Sym_ops[3][i]])
@@ -84,64 +570,335 @@ def get_overlap_list(Coeff, gvec, Sym_ops, center, settings):
 
     return ov_list, symmetry_info
 
-def get_overlaps_of_bands(wf_file, name, spin, bands, centers, PGname, Sym_ops, folder_path_out, settings):
+def energy_sorted_index(KENERGY, encut_trunc):
     """
-    Calculate overlaps for all bands and all symmetries.
+    Index of the g-vectors below a cutoff energy, ordered by kinetic energy
+    so that every lower cutoff is a prefix of the index.
 
     Inputs:
-        wf_file: string that is the path to a WAVECAR file
-        name: string with name (numbering) of defect
+        KENERGY: list of energy of each g-vector
+        encut_trunc: cutoff energy
+    Returns:
+        index of the g-vectors below encut_trunc, by increasing energy
+    """
+    order = np.argsort(KENERGY, kind='stable')
+    n = np.searchsorted(KENERGY[order], encut_trunc, side='left')
+    return order[:n]
+
+def get_gvector_setup(wav, Sym_ops, settings, reduction=None):
+    """
+    Energy sorted g-vectors below the reduced cutoff and their symmetry
+    table, built once per WavecarSession, set of operators and reduction
+    factor and reused by every later overlap calculation.
+
+    Inputs:
+        wav: WavecarSession
+        Sym_ops: array with symmetry operator info,
+                 output for get_symmetry_operators()
+        settings: settings dicitonary
+        reduction: factor reducing encut, default settings['Gvec_reduction']
+
+    Returns:
+        index of the energy sorted g-vectors below the reduced cutoff
+        kinetic energy of these g-vectors
+        SymmetryGTable of Sym_ops and these g-vectors
+        dtype the coefficients are read in
+    """
+    gamma = settings['Gammapoint_calc']
+    if reduction is None:
+        reduction = settings['Gvec_reduction']
+
+    key = (np.asarray(Sym_ops[1], dtype=float).tobytes(), float(reduction), gamma)
+    if key not in wav._symmetry_tables:
+        encut = wav._encut
+        Gvec, KENERGY = wav.gvectors_and_energy(force_Gamma=gamma)
+        KENERGY = KENERGY[np.where(KENERGY < encut)[0]]
+        trunc = energy_sorted_index(KENERGY, encut * reduction)
+        wav._symmetry_tables[key] = (trunc, KENERGY[trunc], SymmetryGTable(Sym_ops, Gvec[trunc]))
+    trunc, kenergy, table = wav._symmetry_tables[key]
+
+    # Only the coefficients below the truncated cutoff are read, the
+    # overlaps are normalized afterwards so no full-record norm is needed
+    dtype = np.complex64 if settings['single_precision_coeffs'] else np.complex128
+    return trunc, kenergy, table, dtype
+
+def sweep_Gvec_reduction(wf_file, spin, bands, centers, Sym_ops, reductions, settings):
+    """
+    Calculates overlaps for several values of Gvec_reduction in a single
+    pass over the coefficients, using the energy sorted g-vectors of the
+    largest reduction factor and cumulative partial sums.
+
+    Inputs:
+        wf_file: string that is the path to a WAVECAR file, or a WavecarSession
         spin: 1 or 2 for spin up or down
         bands: list of band indices
         centers: list of orbital center of each band
         Sym_ops: array with symmetry operator info,
                  output for get_symmetry_operators()
-        folder_path_out: string that is the path to output directory
+        reductions: list of factors reducing encut, each has to leave at
+                    least one g-vector (ValueError otherwise)
         settings: settings dicitonary
 
     Returns:
-        list of overlap info of each band
+        array with normalized overlaps, shape (n_reductions, n_bands, n_ops)
     """
+    wav = open_wavecar(wf_file, lgamma=settings['Gammapoint_calc'])
 
-    G_reduction = settings['Gvec_reduction']
-    gamma = settings['Gammapoint_calc']
+    reductions = np.asarray(reductions, dtype=float)
+    trunc, kenergy, table, dtype = get_gvector_setup(wav, Sym_ops, settings, reductions.max())
+    prefix_lengths = np.searchsorted(kenergy, wav._encut * reductions, side='left')
+    if np.any(prefix_lengths == 0):
+        raise ValueError("Gvec_reduction "+str(reductions[prefix_lengths == 0].tolist())+ \
+                         " leaves no g-vectors below the reduced cutoff, use larger reduction factors")
 
+    sweep = np.empty((len(reductions), len(bands), len(Sym_ops[1])), dtype=complex)
+    for i, band_i in enumerate(bands):
+        Coeffs = wav.read_band(spin, 1, band_i, index=trunc, dtype=dtype)
+        overlaps = table.prefix_overlaps(Coeffs, centers[i], prefix_lengths)
+        sweep[:, i, :] = (overlaps / overlaps[:1]).T
 
-    wav = vaspwfc(wf_file, lgamma=gamma)
-    encut = wav._encut
-    encut_trunc = encut * G_reduction
+    return sweep
 
-    Gvec, KENERGY= gvectors_and_energy(wav, force_Gamma=gamma)
+def choose_Gvec_reduction(reductions, sweep, tol):
+    """
+    Picks the smallest reduction factor whose overlaps all agree with those
+    of the largest reduction factor within a tolerance.
 
+    Inputs:
+        reductions: list of factors reducing encut
+        sweep: overlaps from sweep_Gvec_reduction()
+        tol: largest accepted deviation of any overlap
+    Returns:
+        reduction factor
+    """
+    reductions = np.asarray(reductions, dtype=float)
+    reference = sweep[np.argmax(reductions)]
+    for i in np.argsort(reductions):
+        if np.max(np.abs(sweep[i] - reference)) < tol:
+            return reductions[i]
+    return reductions.max()
+
+class OverlapResult:
+    """
+    Overlaps of the considered bands of one spin channel, as returned by
+    get_overlaps_of_bands() and accepted directly by the analysis stage.
+    Iterating gives [[spin, kpoint, band], overlap list] for each band.
 
-    #Gvec, KENERGY = truncate_gvec(Gvec, KENERGY, encut, G_reduction)
-    KENERGY = KENERGY[np.where(KENERGY < encut)[0]]
-    Gvec = Gvec[np.where(KENERGY < encut_trunc)[0]]
+    Input:
+        name: string with name (numbering) of defect and spin
+        point_group: name of point group
+        symmetry_info: index, symbol, axis and angle of each operator
+        index: [spin, kpoint, band] of each band, shape (n_bands, 3)
+        overlaps: overlaps, shape (n_bands, n_ops); overlaps that are
+                  real have an imaginary part of exactly zero
+    """
+
+    def __init__(self, name, point_group, symmetry_info, index, overlaps):
+        self.name = name
+        self.point_group = point_group
+        self.symmetry_operators = symmetry_info
+        self.index = np.asarray(index, dtype=int).reshape(-1, 3)
+        self.overlaps = np.asarray(overlaps, dtype=complex).reshape(len(self.index), len(symmetry_info))
+
+    @classmethod
+    def from_list(cls, name, point_group, symmetry_info, result):
+        return cls(name, point_group, symmetry_info, [r[0] for r in result], [r[1] for r in result])
+
+    @classmethod
+    def from_files(cls, folder_path_out, name):
+        meta, index, overlaps = load_overlaps(folder_path_out, name)
+        return cls(name, meta["point_group"], meta["symmetry_operators"], index, overlaps)
+
+    def to_list(self):
+        return [[ks.tolist(), [ov.real.item() if ov.imag == 0 else ov.item() for ov in row]] for ks, row in zip(self.index, self.overlaps)]
+
+    @property
+    def bands(self):
+        return self.index[:, 2].tolist()
+
+    def replace_bands(self, other):
+        """
+        Replaces the overlaps of the bands in another OverlapResult, e.g.
+        recomputed with new centers, in place.
+        """
+        rows = [self.bands.index(band) for band in other.bands]
+        self.overlaps[rows] = other.overlaps
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __len__(self):
+        return len(self.index)
+
+# Single writer thread, so output files are written in the order they are
+# requested and never concurrently
+_writer = ThreadPoolExecutor(max_workers=1)
+_pending_writes = []
+
+def write_overlaps(ov_result, folder_path_out, settings):
+    """
+    Writes the overlaps of each band to Overlaps_*.npz, with the point group
+    and symmetry operators in the sidecar Overlaps_*_meta.json. The overlaps
+    are also exported to Overlaps_*.json if settings['overlaps_json'].
+
+    Inputs:
+        ov_result: OverlapResult
+        folder_path_out: string that is the path to output directory
+        settings: settings dicitonary
+    """
+    ov_path = os.path.join(folder_path_out,"Overlaps_"+ov_result.name)
+    meta = {"point_group": ov_result.point_group, "symmetry_operators": ov_result.symmetry_operators}
+
+    np.savez(ov_path+".npz", index=ov_result.index, overlaps=ov_result.overlaps)
+    with open(ov_path+"_meta.json", "w") as outfile:
+        outfile.write(json.dumps(meta))
+
+    if settings['overlaps_json']:
+        result = ov_result.to_list()
+        ov_json = dict(meta, orbitals=[{"index": result[i][0], "overlaps": str(result[i][1])} for i in range(len(result))])
+        with open(ov_path+".json", "w") as outfile:
+            outfile.write(json.dumps(ov_json))
+
+def write_overlaps_async(ov_result, folder_path_out, settings):
+    """
+    Same as write_overlaps() but runs on a background thread, so the
+    analysis can continue with the in-memory result. flush_writes() waits
+    for all pending writes. A copy of ov_result is written, so it can be
+    modified (e.g. by replace_bands()) while the write is pending.
+    """
+    _pending_writes.append(_writer.submit(write_overlaps, copy.deepcopy(ov_result), folder_path_out, settings))
+
+def flush_writes():
+    """
+    Waits until all pending output files are written, errors of the writes
+    are raised here.
+    """
+    while _pending_writes:
+        _pending_writes.pop(0).result()
+
+def load_overlaps(folder_path_out, name):
+    """
+    Reads the overlaps written by write_overlaps().
+
+    Inputs:
+        folder_path_out: string that is the path to output directory
+        name: string with name (numbering) of defect
+    Returns:
+        dictionary with point group and symmetry operator info
+        array with [spin, kpoint, band] of each band, shape (n_bands, 3)
+        array with overlaps, shape (n_bands, n_ops); overlaps that were
+        real have an imaginary part of exactly zero
+    """
+    flush_writes()
+    ov_path = os.path.join(folder_path_out,"Overlaps_"+name)
+    with open(ov_path+"_meta.json", "r") as f:
+        meta = json.load(f)
+    with np.load(ov_path+".npz") as data:
+        return meta, data["index"], data["overlaps"]
+
+def get_overlaps_of_bands(wf_file, name, spin, bands, centers, PGname, Sym_ops, folder_path_out, settings, batched=False, bands_by_degen=None, workers=1, cache=None, write=True):
+    """
+    Calculate overlaps for all bands and all symmetries.
+
+    Inputs:
+        wf_file: string that is the path to a WAVECAR file, or a WavecarSession
+        name: string with name (numbering) of defect
+        spin: 1 or 2 for spin up or down
+        bands: list of band indices
+        centers: list of orbital center of each band
+        Sym_ops: array with symmetry operator info,
+                 output for get_symmetry_operators()
+        folder_path_out: string that is the path to output directory
+        settings: settings dicitonary
+        batched: compute the overlaps of all bands as one matrix operation
+        bands_by_degen: bands grouped by degeneracy, in batched mode the
+                        representation matrices of each degenerate level
+                        are also written to RepMatrices_*.npz
+        workers: number of processes, more than 1 spreads the bands and
+                 symmetry operators over a process pool
+        cache: ResultCache, overlaps computed before from identical
+               inputs are loaded from it instead
+        write: write the overlap files, False when only some of the bands
+               are recomputed and merged into an earlier result
+
+    Returns:
+        OverlapResult, the overlap files are written in the background
+    """
 
+    gamma = settings['Gammapoint_calc']
 
+    # The adaptive cutoff only exists for bands computed one at a time
+    settings_used = [settings[s] for s in ("Gammapoint_calc", "Gvec_reduction", "single_precision_coeffs", "adaptive_Gvec_tolerance")]
+    if settings['adaptive_Gvec_tolerance'] > 0 and (batched or workers > 1):
+        print("adaptive_Gvec_tolerance is ignored for batched or parallel overlaps, the full cutoff is used")
+        settings_used[-1] = 0
+
+    wav = open_wavecar(wf_file, lgamma=gamma)
+    symmetry_info = [[i, Sym_ops[0][i], Sym_ops[2][i], Sym_ops[3][i]] for i in range(len(Sym_ops[1]))]
+
+    # Representation matrices are not cached, they are always recomputed
+    if cache is not None and not (batched and bands_by_degen is not None):
+        key = cache.key("overlaps", cache.wavecar_fingerprint(wav, spin, bands), spin, bands,
+                        np.asarray(centers), Sym_ops[1], settings_used)
+        cached = cache.load_arrays(key)
+        if cached is not None:
+            print("Loaded overlaps from cache!")
+            result = [[[spin,1,band_i], [np.real_if_close(ov).tolist() for ov in row]] for band_i, row in zip(bands, cached["overlaps"])]
+            ov_result = OverlapResult.from_list(name, PGname, symmetry_info, result)
+            if write:
+                write_overlaps_async(ov_result, folder_path_out, settings)
+            return ov_result
+    else:
+        cache = None
+
+    trunc, kenergy, table, dtype = get_gvector_setup(wav, Sym_ops, settings)
 
     pprint(centers)
 
     result = []
 
-    # Loop of the considered bands
-    for i, band_i in enumerate(bands):
-        ks = [spin,1,band_i]
-        Coeffs = wav.readBandCoeff(*ks, norm=True)
+    if batched or workers > 1:
+        Coeffs = np.array([wav.read_band(spin, 1, band_i, index=trunc, dtype=dtype) for band_i in bands])
+        if workers > 1:
+            ov_matrix = parallel_overlap_matrix(table, Coeffs, centers, workers)
+        else:
+            ov_matrix = table.overlap_matrix(Coeffs, centers)
+        ov_matrix /= ov_matrix[:, :1]
+        for i, band_i in enumerate(bands):
+            ov_list = [np.real_if_close(ov).tolist() for ov in ov_matrix[i]]
+            result.append([[spin,1,band_i],ov_list])
+
+        if batched and bands_by_degen is not None:
+            rep_mats = {}
+            for j, deg_bands in enumerate(bands_by_degen):
+                rows = [bands.index(int(band)) for band in deg_bands]
+                rep_mats["bands_"+str(j)] = np.array(deg_bands, dtype=int)
+                rep_mats["matrices_"+str(j)] = table.rep_matrices(Coeffs[rows], centers[rows[0]])
+            np.savez(os.path.join(folder_path_out,"RepMatrices_"+name), **rep_mats)
 
-        #Coeffs = truncate_coeffs(Coeffs, KENERGY, encut, G_reduction)
-        Coeffs = Coeffs[np.where(KENERGY < encut_trunc)[0]]
+    else:
+        # Loop of the considered bands
+        gvec_counts = []
+        for i, band_i in enumerate(bands):
+            ks = [spin,1,band_i]
+            Coeffs = wav.read_band(*ks, index=trunc, dtype=dtype)
 
-        ov_list, symmetry_info = get_overlap_list(Coeffs, Gvec, Sym_ops, centers[i], settings)
+            ov_list, symmetry_info = get_overlap_list(Coeffs, table.gvec, Sym_ops, centers[i], settings, table, kenergy, gvec_counts)
 
-        result.append([ks,ov_list])
+            result.append([ks,ov_list])
 
-    ov_json = {"point_group": PGname, "symmetry_operators": symmetry_info, "orbitals": [{"index": result[i][0], "overlaps": str(result[i][1])} for i in range(len(result))]}
+        if gvec_counts:
+            print("Adaptive cutoff used "+str(min(gvec_counts))+" to "+str(max(gvec_counts))+" of "+str(len(trunc))+ \
+                  " g-vectors for "+str(len(bands))+" bands")
 
-    with open(os.path.join(folder_path_out,"Overlaps_"+name+".json"), "w") as outfile:
-        outfile.write(json.dumps(ov_json))
+    if cache is not None:
+        cache.save_arrays(key, overlaps=np.array([r[1] for r in result], dtype=complex))
 
-    return result
+    ov_result = OverlapResult.from_list(name, PGname, symmetry_info, result)
+    if write:
+        write_overlaps_async(ov_result, folder_path_out, settings)
+
+    return ov_result
 
 def truncate_gvec(Gvec, KENERGY, encut, reduction):
     """
@@ -196,64 +953,333 @@ def truncate_coeffs(Coeffs, KENERGY, encut, reduction):
     #new_coeffs = Coeffs[np.where(KENERGY < encut_trunc)[0]]
     return np.array(new_coeffs)
 
-def get_orbital_centers(wf_file, bands_by_degen, name, spin, folder_path_out, settings):
+def full_sphere_coeffs(Gvec, Coeffs, gamma):
     """
-    Calculates the center of the orbital between the chosen bands,
-    degenerate states are considered together.
+    Expands the coefficients of a Gamma-point WAVECAR, stored on a half
+    sphere, to the full sphere of g-vectors using C(-G) = C(G)*. The stored
+    coefficients of G != 0 are scaled by sqrt(2), this is undone here.
 
     Input:
-        wf_file: filepath to WAVECAR file
-        bands_by_degen: bands grouped by degeneracy
-        name: string with name (numbering) of defect
-        spin: 1 or 2 for spin channel 1 or 2
-        folder_path_out: string that is the path to output directory
-        settings: settings dicitonary
+        Gvec: list of g-vectors
+        Coeffs: list of plane wave coefficients
+        gamma: True for Gamma-point only WAVECAR
     Returns:
-        list of centers of orbitals
+        full list of g-vectors
+        full list of plane wave coefficients
+    """
+    if not gamma:
+        return np.asarray(Gvec, dtype=int), np.asarray(Coeffs)
+    Gvec = np.asarray(Gvec, dtype=int)
+    nonzero = np.any(Gvec != 0, axis=1)
+    C = np.where(nonzero, Coeffs / np.sqrt(2), Coeffs)
+    return np.concatenate([Gvec, -Gvec[nonzero]]), np.concatenate([C, C[nonzero].conj()])
+
+def find_circular_mean_reciprocal(Gvec, coeff_array, gamma):
     """
+    Finds the circular mean of |psi|^2 of a (degenerate) orbital directly
+    from its plane wave coefficients. The moments <exp(2*pi*i x_k)> are
+    sums of products of coefficients of neighbouring g-vectors,
+    sum_G C(G+e_k)* C(G), so no realspace grid is needed.
 
+    Input:
+        Gvec: list of g-vectors
+        coeff_array: list with the plane wave coefficients of each band
+        gamma: True for Gamma-point only WAVECAR
+    Returns:
+        position of the circular mean in the lattice basis
+    """
+    moments = np.zeros(3, dtype=complex)
+    neighbours = None
+    for Coeffs in coeff_array:
+        G_full, C_full = full_sphere_coeffs(Gvec, Coeffs, gamma)
+        if neighbours is None:
+            gindex = GvecIndex(G_full)
+            neighbours = [gindex.find(G_full + e_k) for e_k in np.eye(3, dtype=int)]
+        for k, j in enumerate(neighbours):
+            found = j >= 0
+            moments[k] += np.sum(C_full[j[found]].conj() * C_full[found])
+
+    circ_mean = np.angle(moments)/(2*m.pi)
+    return circ_mean % 1
+
+def wavefunction_on_window(G_full, C_full, points):
+    """
+    Evaluates a wavefunction on a box of fractional coordinates, summing the
+    plane waves directly one axis at a time instead of using an FFT over
+    the whole cell.
 
+    Input:
+        G_full: full list of g-vectors
+        C_full: full list of plane wave coefficients
+        points: list with the fractional coordinates along each of the three axes
+    Returns:
+        wavefunction on the box, shape (n_0, n_1, n_2)
+    """
+    gmin = G_full.min(axis=0)
+    shape = G_full.max(axis=0) - gmin + 1
+    cube = np.zeros(shape, dtype=complex)
+    shifted = G_full - gmin
+    cube[shifted[:,0], shifted[:,1], shifted[:,2]] = C_full
 
-    gamma = settings['Gammapoint_calc']
-    grid_mult = settings['realgrid_mult']
-    percent = settings['percent_cutoff']
+    E = [np.exp(2j*m.pi*np.outer(gmin[k] + np.arange(shape[k]), points[k])) for k in range(3)]
+    return np.einsum('abc,ax,by,cz->xyz', cube, E[0], E[1], E[2], optimize=True)
 
-    wav = vaspwfc(wf_file, lgamma=gamma)
-    Gvec= wav.gvectors(force_Gamma=gamma)
+def refine_center_multigrid(Gvec, coeff_array, gamma, coarse_center, spacing, percent, window=0.15):
+    """
+    Refines a coarse orbital center by evaluating |psi|^2 at fine resolution
+    only inside a window around it.
 
-    grid = wav._ngrid.copy() * grid_mult
+    Input:
+        Gvec: list of g-vectors
+        coeff_array: list with the plane wave coefficients of each band
+        gamma: True for Gamma-point only WAVECAR
+        coarse_center: estimate of the center in the lattice basis
+        spacing: fine grid spacing along each axis, fractional
+        percent: sets psi=0 when |psi|^2 < max * percent
+        window: half width of the window along each axis, fractional
+    Returns:
+        center of orbital
+    """
+    points = []
+    for k in range(3):
+        half = int(np.ceil(window/spacing[k]))
+        points.append(coarse_center[k] + spacing[k]*np.arange(-half, half+1))
+
+    wf2_tot = 0
+    for Coeffs in coeff_array:
+        G_full, C_full = full_sphere_coeffs(Gvec, Coeffs, gamma)
+        psi = wavefunction_on_window(G_full, C_full, points)
+        wf2_tot = wf2_tot + np.real(psi*psi.conj())
+
+    cutoff = np.max(wf2_tot)*percent
+    wf2_tot[wf2_tot <= cutoff] = 0
+    wf2_tot /= np.sum(wf2_tot)
+
+    projections = [wf2_tot.sum(axis=(1,2)), wf2_tot.sum(axis=(0,2)), wf2_tot.sum(axis=(0,1))]
+    avg_pos = [np.sum(points[k]*projections[k]) for k in range(3)]
+    return np.array(avg_pos) % 1
+
+def calc_center(wav, Gvec, spin, deg_bands, settings):
+    """
+    Calculates the center of a (degenerate) orbital from its realspace wavefunction,
+    or from its plane wave coefficients if settings['center_method'] is "reciprocal".
+    With "multigrid" the center is estimated on the native FFT grid and then
+    refined at realgrid_mult times the resolution inside a window around it.
 
-    centers = []
+    Input:
+        wav: WavecarSession
+        Gvec: g-vectors of the wavefunction
+        spin: 1 or 2 for spin channel 1 or 2
+        deg_bands: list of degenerate bands
+        settings: settings dicitonary
+    Returns:
+        center of orbital
+    """
+    method = settings['center_method']
+    percent = settings['percent_cutoff']
 
-    for deg_bands in bands_by_degen:
-        wf_array = []
-        for band in deg_bands:
+    if method == "reciprocal":
+        coeff_array = [wav.readBandCoeff(spin, 1, int(band), norm=True) for band in deg_bands]
+        shift = find_circular_mean_reciprocal(Gvec, coeff_array, wav.lgamma)
+        if percent == 0:
+            return shift
+        # The cut off |psi|^2 needs a realspace grid, the native grid is enough.
+        # Its points are at i/n, the same coordinates as the reciprocal shift
+        grid = wav._ngrid.copy()
+        wf_array = [wav.wfc_r(spin, 1, int(band), gvec=Gvec, Cg=Coeffs, ngrid=grid) for band, Coeffs in zip(deg_bands, coeff_array)]
+        circ_mean, c = find_circular_and_shifted_mean(wf_array, percent, shift, periodic=True)
+        return c
+
+    if method == "multigrid":
+        coeff_array = [wav.readBandCoeff(spin, 1, int(band), norm=True) for band in deg_bands]
+        grid = wav._ngrid.copy()
+        wf_array = [wav.wfc_r(spin, 1, int(band), gvec=Gvec, Cg=Coeffs, ngrid=grid) for band, Coeffs in zip(deg_bands, coeff_array)]
+        shift, coarse_center = find_circular_and_shifted_mean(wf_array, percent)
+        del wf_array
+
+        spacing = 1/(grid*settings['realgrid_mult'])
+        c = refine_center_multigrid(Gvec, coeff_array, wav.lgamma, coarse_center, spacing, percent)
+        precision = spacing*np.linalg.norm(wav._Acell, axis=1)
+        print("Bands "+str(deg_bands)+": center "+str(c)+" refined from "+str(coarse_center)+ \
+              ", grid spacing "+str(np.round(precision, 4))+" Å")
+        return c
+
+    grid = wav._ngrid.copy() * settings['realgrid_mult']
+
+    wf_array = []
+    for band in deg_bands:
+
+        ks = [spin,1,int(band)]
+        Coeffs = wav.readBandCoeff(*ks, norm=True)
+        realwf = wav.wfc_r(*ks, gvec=Gvec, Cg=Coeffs, ngrid=grid)
+        wf_array.append(realwf)
 
-            ks = [spin,1,int(band)]
-            Coeffs = wav.readBandCoeff(*ks, norm=True)
-            realwf = wav.wfc_r(*ks, gvec=Gvec, Cg=Coeffs, ngrid=grid)
-            wf_array.append(realwf)
+    # Regular center of mass
+    #c = find_average_position_general(wf_array, percent)
 
-        # Regular center of mass
-        #c = find_average_position_general(wf_array, percent)
+    # shift the grid so center of mass can be taken for defects close to
+    # supercell edges
+    shift, c = find_circular_and_shifted_mean(wf_array, percent)
+    return c
 
-        # shift the grid so center of mass can be taken for defects close to
-        # supercell edges
-        shift = find_circular_mean_realspace_opt(wf_array, percent)
-        c = find_average_position_shifted(wf_array, percent, shift)
+_center_worker_state = {}
 
+def _init_center_worker(wf_file, gamma):
+    """
+    Opens the WAVECAR once in each process of the center pool.
+    """
+    wav = WavecarSession(wf_file, lgamma=gamma)
+    _center_worker_state["wav"] = wav
+    _center_worker_state["Gvec"] = wav.gvectors(force_Gamma=gamma)
 
-        for i in range(len(deg_bands)):
-            centers.append(c)
+def _center_worker(spin, deg_bands, settings):
+    """
+    Work unit of get_orbital_centers() when run on a process pool.
+    """
+    return calc_center(_center_worker_state["wav"], _center_worker_state["Gvec"], spin, deg_bands, settings)
 
+def snap_to_fixed_points(center, Sym_ops, lattice, tol=1e-6):
+    """
+    Moves a center to the closest point fixed by all symmetry operators,
+    up to lattice translations, i.e. S x = x + n for every operator S and
+    integer vectors n. The translations n are those closest to the center,
+    and the shortest displacement in cartesian coordinates is used.
 
+    Input:
+        center: center of orbital in fractional coordinates
+        Sym_ops: array with symmetry operator info,
+                 output for get_symmetry_operators()
+        lattice: lattice vectors as columns
+        tol: tolerance in fractional coordinates
+    Returns:
+        snapped center in fractional coordinates
+        length of the displacement, nan if no fixed point was found and
+        the center is returned unchanged
+    """
+    center = np.asarray(center, dtype=float)
+    lattice = np.asarray(lattice, dtype=float)
+    B = np.concatenate([np.asarray(S, dtype=float) - np.eye(3) for S in Sym_ops[1]])
+    B_cart_inv = np.linalg.pinv(B.dot(np.linalg.inv(lattice)))
+
+    x = center
+    for i in range(3):
+        Bx = B.dot(x)
+        r = np.round(Bx) - Bx
+        if np.all(np.abs(r) < tol):
+            y = lattice.dot(x - center)
+            return x, float(np.linalg.norm(y))
+        # Solve B d = r for the displacement d with the smallest cartesian norm,
+        # when the rounded translations are inconsistent this is repeated
+        x = x + np.linalg.solve(lattice, B_cart_inv.dot(r))
+    return center, float("nan")
+
+def write_centers(centers, bands_by_degen, name, folder_path_out, displacements=None):
+    """
+    Writes the centers to Centers_*.npy and Centers_*.txt.
+
+    Input:
+        centers: list of centers of orbitals
+        bands_by_degen: bands grouped by degeneracy
+        name: string with name (numbering) of defect
+        folder_path_out: string that is the path to output directory
+        displacements: distance each center was moved when snapped to the
+                       fixed points of the symmetry operators
+    """
     c_path = os.path.join(folder_path_out,"Centers_"+name)
     np.save(c_path, centers)
     file = open(c_path+".txt", "w")
     file.write("Band       Center\n")
     for i, deg_bands in enumerate(bands_by_degen):
-        file.write(str(deg_bands)+"   "+str(centers[i])+"\n")
+        file.write(str(deg_bands)+"   "+str(centers[i]))
+        if displacements is not None:
+            file.write("   snapped by "+str(round(displacements[i], 4)))
+        file.write("\n")
     file.close()
+
+def snap_centers(centers, Sym_ops, pos_file):
+    """
+    Snaps each center with snap_to_fixed_points().
+
+    Input:
+        centers: list of centers of orbitals
+        Sym_ops: array with symmetry operator info,
+                 output for get_symmetry_operators()
+        pos_file: string that is the path to a crystal structure file like POSCAR or CONTCAR
+    Returns:
+        list of snapped centers
+        list of displacements
+    """
+    cell, min_dist = get_cell_from_poscar(pos_file)
+    snapped = [snap_to_fixed_points(c, Sym_ops, cell[0]) for c in centers]
+    return [s[0] for s in snapped], [s[1] for s in snapped]
+
+def get_orbital_centers(wf_file, bands_by_degen, name, spin, folder_path_out, settings, workers=1, cache=None, Sym_ops=None, pos_file=None):
+    """
+    Calculates the center of the orbital between the chosen bands,
+    degenerate states are considered together.
+
+    Input:
+        wf_file: filepath to WAVECAR file, or a WavecarSession
+        bands_by_degen: bands grouped by degeneracy
+        name: string with name (numbering) of defect
+        spin: 1 or 2 for spin channel 1 or 2
+        folder_path_out: string that is the path to output directory
+        settings: settings dicitonary
+        workers: number of processes, more than 1 computes the centers of
+                 the degenerate levels on a process pool
+        cache: ResultCache, centers computed before from identical
+               inputs are loaded from it instead
+        Sym_ops: array with symmetry operator info, with pos_file needed
+                 to snap the centers if settings['snap_centers']
+        pos_file: string that is the path to a crystal structure file like POSCAR or CONTCAR
+    Returns:
+        list of centers of orbitals
+    """
+
+
+
+    gamma = settings['Gammapoint_calc']
+
+    wav = open_wavecar(wf_file, lgamma=gamma)
+
+    centers = None
+    if cache is not None:
+        bands = [int(band) for deg_bands in bands_by_degen for band in deg_bands]
+        key = cache.key("centers", cache.wavecar_fingerprint(wav, spin, bands), spin, bands_by_degen,
+                        [settings[s] for s in ("Gammapoint_calc", "realgrid_mult", "percent_cutoff", "center_method")])
+        cached = cache.load_arrays(key)
+        if cached is not None:
+            print("Loaded centers from cache!")
+            centers = list(cached["centers"])
+
+    if centers is None:
+        Gvec= wav.gvectors(force_Gamma=gamma)
+
+        centers = []
+
+        if workers > 1:
+            # No file is being written by the writer thread when the pool forks
+            flush_writes()
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_center_worker, initargs=(wav.path, gamma)) as pool:
+                level_centers = list(pool.map(_center_worker, [spin]*len(bands_by_degen), bands_by_degen,
+                                              [settings]*len(bands_by_degen)))
+        else:
+            level_centers = [calc_center(wav, Gvec, spin, deg_bands, settings) for deg_bands in bands_by_degen]
+
+        for deg_bands, c in zip(bands_by_degen, level_centers):
+            for i in range(len(deg_bands)):
+                centers.append(c)
+
+        if cache is not None:
+            cache.save_arrays(key, centers=np.array(centers))
+
+    # The cache holds the centers before snapping
+    displacements = None
+    if settings['snap_centers'] and Sym_ops is not None and pos_file is not None:
+        centers, displacements = snap_centers(centers, Sym_ops, pos_file)
+        print("Centers snapped to fixed points, displacements: ", [round(d, 4) for d in displacements])
+
+    write_centers(centers, bands_by_degen, name, folder_path_out, displacements)
     return centers
 
 def get_good_centers(name, bands, no_irr, folder_path_out):
@@ -277,6 +1303,69 @@ def get_good_centers(name, bands, no_irr, folder_path_out):
         centers2 = centers2[np.all(centers2 != c,axis=1)]
     return centers2
 
+def get_candidate_centers(pos_file, Sym_ops, good_centers, tol=1e-3):
+    """
+    Collects candidate centers for orbitals where no irrep was found: known
+    good centers, the atom of a unique species, atoms fixed by all symmetry
+    operators and the points with coordinates 0 or 1/2 fixed by all
+    symmetry operators.
+
+    Inputs:
+        pos_file: string that is the path to a crystal structure file like POSCAR or CONTCAR
+        Sym_ops: array with symmetry operator info,
+                 output for get_symmetry_operators()
+        good_centers: list of centers known to give irreps
+        tol: tolerance in fractional coordinates
+    Returns:
+        array with candidate centers, without duplicates
+    """
+    sym_ops = np.asarray(Sym_ops[1], dtype=float)
+
+    def is_fixed(r):
+        d = np.einsum('kij,j->ki', sym_ops, r) - r
+        return np.all(np.abs(d - np.round(d)) < tol)
+
+    candidates = [np.asarray(c, dtype=float) for c in good_centers]
+
+    defect_pos = get_single_species(pos_file)
+    if defect_pos != None:
+        candidates.append(np.array(defect_pos, dtype=float))
+
+    cell, min_dist = get_cell_from_poscar(pos_file)
+    candidates += [r for r in cell[1] if is_fixed(r)]
+
+    half = np.array(np.meshgrid([0, 0.5], [0, 0.5], [0, 0.5], indexing='ij')).reshape(3, -1).T
+    candidates += [r for r in half if is_fixed(r)]
+
+    unique = []
+    for c in candidates:
+        if not any(np.all(np.abs((c - u + 0.5) % 1 - 0.5) < tol) for u in unique):
+            unique.append(c)
+    return np.array(unique).reshape(-1, 3)
+
+def get_candidate_overlaps(wf_file, spin, bands, candidates, Sym_ops, settings):
+    """
+    Calculates normalized overlaps of the bands for every candidate center,
+    with the same g-vectors as get_overlaps_of_bands().
+
+    Inputs:
+        wf_file: string that is the path to a WAVECAR file, or a WavecarSession
+        spin: 1 or 2 for spin up or down
+        bands: list of band indices
+        candidates: list of candidate centers
+        Sym_ops: array with symmetry operator info,
+                 output for get_symmetry_operators()
+        settings: settings dicitonary
+    Returns:
+        array with overlaps, shape (n_candidates, n_bands, n_ops)
+    """
+    wav = open_wavecar(wf_file, lgamma=settings['Gammapoint_calc'])
+    trunc, kenergy, table, dtype = get_gvector_setup(wav, Sym_ops, settings)
+
+    Coeffs = np.array([wav.read_band(spin, 1, band_i, index=trunc, dtype=dtype) for band_i in bands])
+    overlaps = table.candidate_overlaps(Coeffs, candidates)
+    return overlaps / overlaps[:, :, :1]
+
 def replace_bad_centers(name, bands, no_irr, good_centers, folder_path_out):
     """
     Replaces bad centers with ones known to be good.
@@ -332,32 +1421,36 @@ def write_overlaps_to_text(overlap_array, folder_path_out, name):
     file.close()
     return 0
 
-def write_overlaps_to_text_fancy(PGname, folder_path_out, name, settings):
+def write_overlaps_to_text_fancy(PGname, folder_path_out, name, settings, overlaps=None, point_group=None):
     """
     Writes the overlap array to a .txt file readable by humans.
     Input:
         PGname: name of point group
         folder_path_out: string with path to output directory
         name: string with name of
+        overlaps: OverlapResult of spin up and down, read from the
+                  overlap files if not given
+        point_group: PointGroup, only the character table is read
+                     from file if not given
     Returns:
         0
     """
 
-    ov1 = os.path.join(folder_path_out,"Overlaps_"+name+"_S1.json")
-    ov2 = os.path.join(folder_path_out,"Overlaps_"+name+"_S2.json")
-    f1 = open(ov1,"rb")
-    f2 = open(ov2,"rb")
-    ov_array1 = json.load(f1)
-    ov_array2 = json.load(f2)
-    f1.close()
-    f2.close()
+    if overlaps is None:
+        overlaps = [None, None]
+    overlaps = [ov if ov is not None else OverlapResult.from_files(folder_path_out, name+spin) for ov, spin in zip(overlaps, ("_S1", "_S2"))]
+    index1, ov_array1 = overlaps[0].index, overlaps[0].overlaps
+    index2, ov_array2 = overlaps[1].index, overlaps[1].overlaps
 
     rounding = 3
     space = 10+rounding*2
 
     ov_out = os.path.join(folder_path_out,"Overlaps"+name+".txt")
     file = open(ov_out, "w+")
-    ch_table, pos_vector = get_character_table(PGname,settings)
+    if point_group is None:
+        ch_table, pos_vector = get_character_table(PGname,settings)
+    else:
+        ch_table = point_group.ch_table
 
     file.write("Overlaps\n")
     file.write("\nPoint group: "+PGname+"\n")
@@ -378,9 +1471,9 @@ def write_overlaps_to_text_fancy(PGname, folder_path_out, name, settings):
 
     file.write("Spin up\n"+sym_string+"\n")
 
-    for orbital_info in ov_array1["orbitals"]:
-        ov_string = f"{orbital_info['index'][2]:<12}"
-        for overlap in ast.literal_eval(orbital_info["overlaps"]):
+    for index, overlaps in zip(index1, ov_array1):
+        ov_string = f"{index[2]:<12}"
+        for overlap in overlaps:
             ov = round(np.real(overlap),rounding) + 1j*round(np.imag(overlap),rounding)
             ov = str(ov).strip('(').strip(')')
             ov_string += f"{ov:<{space}}"
@@ -388,9 +1481,9 @@ def write_overlaps_to_text_fancy(PGname, folder_path_out, name, settings):
 
     file.write("\nSpin down\n"+sym_string+"\n")
 
-    for orbital_info in ov_array2["orbitals"]:
-        ov_string = f"{orbital_info['index'][2]:<12}"
-        for overlap in ast.literal_eval(orbital_info["overlaps"]):
+    for index, overlaps in zip(index2, ov_array2):
+        ov_string = f"{index[2]:<12}"
+        for overlap in overlaps:
             ov = round(np.real(overlap),rounding) + 1j*round(np.imag(overlap),rounding)
             ov = str(ov).strip('(').strip(')')
             ov_string += f"{ov:<{space}}"
@@ -217,12 +217,7 @@ def plot_ipr(HOB, eig_file, vb, ipr_both, ax, folder_path):
             if ipr > ipr_avg:
                 print("Band "+str(bands[i])+" Spin "+str(spin_channel)+" is localized. IPR: "+str(ipr))
 
-        file = open(eig_file,"r")
-        contents = file.readlines()
-        file.close()
-        eigenvalues = []
-        for b in bands:
-            eigenvalues.append(float(contents[b+7].split()[spin_channel])-vb)
+        eigenvalues = get_eigenval(eig_file).energy(spin_channel, bands)-vb
 
         if spin_channel == 1:
             c = 'm'
@@ -262,6 +257,7 @@ def plot_levels_and_ipr(folder_path, plotname, eig_file= "EIGENVAL", filename=""
     plt.rcParams["figure.figsize"] = (14.4,7.2)
 
     HOB = find_HOB(eig_file)
+    wf_file = open_wavecar(wf_file)
     vb, cb, iprs1 = find_vb_and_cb(eig_file, wf_file)
     iprs2 = calc_ipr(wf_file, 2, HOB)
     gs = gridspec.GridSpec(1, 2, width_ratios=[3, 1])
@@ -329,10 +325,7 @@ def plot_levels_one_spin(folder_path, filename, plotname, eig_file, vb = None, c
 
 
 
-    ov_path = os.path.join(folder_path,"Overlaps_"+filename+".json")
-    f = open(ov_path, "r")
-    ov = json.load(f)
-    f.close()
+    ov, index, overlaps = load_overlaps(folder_path, filename)
     if len(ov["symmetry_operators"]) == 1:
         principal_axis = np.array([0,0,0])
     else:
@@ -423,10 +416,7 @@ def plot_levels(folder_path, plotname, eig_file= "EIGENVAL", pos_file="CONTCAR",
             allowed_tr2.append(tr)
 
     # Read principal axis from overlap file
-    ov_path = os.path.join(folder_path,"Overlaps_"+filename+"_S2.json")
-    f = open(ov_path, "r")
-    ov = json.load(f)
-    f.close()
+    ov, index, overlaps = load_overlaps(folder_path, filename+"_S2")
     if len(ov["symmetry_operators"]) == 1:
         principal_axis = np.array([0,0,0])
     else:
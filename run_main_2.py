@@ -6,7 +6,7 @@ import sys
 
 print("Starting symmetry analysis for a defect!\n")
 
-wf_file = "WAVECAR"
+wf_file = WavecarSession("WAVECAR")
 HOB=find_HOB()
 
 iprs1 = calc_ipr(wf_file,1,HOB)
@@ -25,6 +25,6 @@ for n, ipr in enumerate(iprs2):
         #print(HOB-15+n, ipr)
         s2bands.append(HOB-15+n)
 
-main(s1bands, s2bands)
+main(s1bands, s2bands, wf_file=wf_file)
 
 print("Done with symmetry analysis for a defect!")